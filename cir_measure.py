@@ -2,7 +2,7 @@
 # -*- coding: utf-8 -*-
 #
 # This is the main program that
-# - runs rtl_tcp to record files containing samples
+# - runs rtl_tcp, or another sample source, to receive samples
 # - runs correlate_with_ref to calculate the CIR
 # - runs a webserver to present the information
 #
@@ -12,7 +12,7 @@
 # Licence: The MIT License, see LICENCE file
 
 import sys
-from bottle import route, run, template, static_file, request
+from bottle import route, run, template, static_file, request, redirect, abort
 import subprocess
 import time
 import datetime
@@ -20,20 +20,44 @@ import multiprocessing as mp
 import threading
 import socket
 import correlate_with_ref
+import fft_plans
+import rtl_tcp_client
 import shlex
 import argparse
-import collections
+import io
+import os
 import numpy as np
 
 # The record and correlate tasks run in alternance.
 # Maybe later we want to run them simultaneously in a small
 # pipeline.
 
-class RTLSDR_Receiver(threading.Thread):
-    """Connection between the rtlsdr and our script is done using a TCP socket. This
-    class handles running the rtl_tcp tool, and reads the incoming data stream into
-    a local buffer. The buffer size is capped, and works as a FIFO, because analysis
-    of the data is slower than capturing it. We therefore want to lose some data"""
+# Largest number of bytes read from the source at once
+RECV_BLOCK = 65536
+
+# rtl_tcp must accept our connection within this time after being started,
+# we try to connect every RTL_TCP_RETRY_INTERVAL until it does.
+RTL_TCP_STARTUP_TIMEOUT = 10 # seconds
+RTL_TCP_RETRY_INTERVAL = 0.05 # seconds
+
+class SampleReceiver(threading.Thread):
+    """Base class of the sources of u8 I/Q samples. It reads the incoming data
+    stream into a local buffer. The buffer size is capped, and works as a FIFO,
+    because analysis of the data is slower than capturing it. We therefore want
+    to lose some data
+
+    The buffer is a ring of max_num_bytes bytes. The source writes directly
+    into it, and when it is full the oldest data is dropped by moving the
+    read position. The data given to the consumer is not copied if possible,
+    and is then kept until the consumer asks for more. In the meantime, new
+    data is dropped when the buffer is full.
+
+    Subclasses implement open_source_(), recv_into_() and close_source_(),
+    and set can_retune and implement retune_() if they can change the
+    frequency or the gain."""
+
+    source_name = None
+    can_retune = False
 
     def __init__(self, options):
         threading.Thread.__init__(self)
@@ -50,57 +74,133 @@ class RTLSDR_Receiver(threading.Thread):
 
         self.event_stop = threading.Event()
 
-        self.rtl_tcp_port = 59152 # chosen randomly
+        # Set when the source must be opened again when it ends, to apply
+        # new settings
+        self.event_reopen = threading.Event()
+
+        # The data in the ring buffer starts at read_ix and contains num_bytes
+        # bytes, possibly wrapping around the end of the buffer. New data is
+        # written at write_ix.
+        #
+        # read_ix is always on the I byte of a sample, and num_bytes is even.
+        # The source can return an odd number of bytes, the I byte of the
+        # last incomplete sample is then pending after the num_bytes bytes,
+        # until its Q byte is received.
+        self.buf = np.zeros(self.max_num_bytes, dtype=np.uint8)
+        self.read_ix = 0
+        self.write_ix = 0
+        self.num_bytes = 0
+        self.num_pending_bytes = 0
+
+        # Number of bytes before read_ix still used by the consumer
+        self.num_bytes_in_use = 0
+
+        # Data that does not fit in the ring is received here and dropped
+        self.discard_buf = bytearray(RECV_BLOCK)
+
+        # The indices are updated by the receiver and the consumer, the lock
+        # makes sure they are consistent. The source writes outside of the
+        # area of valid data, and does not need the lock.
+        self.data_lock = threading.Lock()
 
-        self.data_queue = collections.deque()
+        # Time in seconds between opening the source and receiving the first
+        # samples, once they are received
+        self.start_time = None
+        self.startup_time = None
 
-        # While the data_queue is itself thread-safe, we need to make sure
-        # the consumer cannot preeempt the little housekeeping we do in run()
-        # to keep the maximum queue length.
-        self.data_lock = threading.Lock()
+    def open_source_(self):
+        """Start the source, returns False if that is not possible"""
+        raise NotImplementedError()
 
-        self.rtlsdr_proc = None
+    def recv_into_(self, buf):
+        """Receive at most len(buf) bytes into buf, and return their number,
+        0 at the end of the stream"""
+        raise NotImplementedError()
+
+    def close_source_(self):
+        pass
+
+    def retune_(self, freq=None, gain=None):
+        """Apply the frequency in Hz and the gain in dB, if given, to the
+        source. Returns True if the samples received before must be dropped."""
+        raise NotImplementedError()
 
     def run(self):
-        rtl_tcp_cmdline = shlex.split("rtl_tcp -f {} -s {} -g {} -p {}".format(self.freq, self.rate, self.gain, self.rtl_tcp_port))
-        self.rtlsdr_proc = subprocess.Popen(rtl_tcp_cmdline)
+        self.start_time = time.time()
 
-        time.sleep(1.5)
+        if not self.open_source_():
+            self.close_source_()
+            print("Receiver thread ends")
+            return
 
-        self.sock = socket.socket()
-        self.sock.connect(("localhost", self.rtl_tcp_port))
+        buf_view = memoryview(self.buf)
 
         while not self.event_stop.is_set():
-            try:
-                samples = self.sock.recv(1024)
+            # Reserve the space up to the end of the buffer, dropping the
+            # oldest data if it is there. The data still used by the consumer
+            # must not be overwritten, only the free space can then be used.
+            with self.data_lock:
+                n_reserved = min(RECV_BLOCK, self.max_num_bytes - self.write_ix)
+                num_stored = self.num_bytes + self.num_pending_bytes
+
+                if self.num_bytes_in_use:
+                    n_reserved = min(n_reserved,
+                            self.max_num_bytes - self.num_bytes_in_use - num_stored)
+                else:
+                    # Only drop whole samples, to keep read_ix on an I byte
+                    num_to_delete = num_stored + n_reserved - self.max_num_bytes
+                    if num_to_delete > 0:
+                        num_to_delete = min(num_to_delete + num_to_delete % 2, self.num_bytes)
+                        self.read_ix = (self.read_ix + num_to_delete) % self.max_num_bytes
+                        self.num_bytes -= num_to_delete
+                        n_reserved = min(n_reserved, self.max_num_bytes -
+                                self.num_bytes - self.num_pending_bytes)
+
+            if n_reserved > 0:
+                target = buf_view[self.write_ix:self.write_ix + n_reserved]
+            else:
+                target = self.discard_buf
 
-                self.data_queue.extend(samples)
+            try:
+                n_received = self.recv_into_(target)
             except:
-                print('Socket error')
+                print('Receive error')
                 break
 
-            self.data_lock.acquire()
+            if n_received == 0:
+                if self.event_reopen.is_set() and not self.event_stop.is_set():
+                    self.event_reopen.clear()
+                    self.close_source_()
+                    # The new stream starts with a whole sample
+                    self.drop_pending_byte_()
+                    self.drop_samples()
+                    if self.open_source_():
+                        continue
+
+                print('End of the samples')
+                break
 
-            # try/catch/except to make sure we release the lock, and
-            # re-raise any exception up
-            try:
-                n_bytes = len(self.data_queue)
+            if self.startup_time is None:
+                self.startup_time = time.time() - self.start_time
+                print("First samples received {:.3f}s after starting {}".format(
+                    self.startup_time, self.source_name))
+
+            if n_reserved > 0:
+                with self.data_lock:
+                    self.write_ix = (self.write_ix + n_received) % self.max_num_bytes
+                    num_stored = self.num_bytes + self.num_pending_bytes + n_received
+                    self.num_pending_bytes = num_stored % 2
+                    self.num_bytes = num_stored - self.num_pending_bytes
+            else:
+                try:
+                    self.drop_lost_samples_(n_received)
+                except:
+                    print('Receive error')
+                    break
 
-                if n_bytes > self.max_num_bytes:
-                    num_to_delete = n_bytes - self.max_num_bytes
-                    for i in range(num_to_delete):
-                        self.data_queue.popleft()
-            except:
-                raise
-            finally:
-                self.data_lock.release()
         print("Receiver leaving")
 
-        self.sock.close()
-
-        self.rtlsdr_proc.terminate()
-
-        self.rtlsdr_proc.wait()
+        self.close_source_()
 
         print("Receiver thread ends")
 
@@ -108,65 +208,365 @@ class RTLSDR_Receiver(threading.Thread):
         self.event_stop.set()
         self.join()
 
+    def drop_pending_byte_(self):
+        with self.data_lock:
+            self.write_ix = (self.write_ix - self.num_pending_bytes) % self.max_num_bytes
+            self.num_pending_bytes = 0
+
+    def drop_lost_samples_(self, n_lost):
+        """Called when n_lost bytes could not be stored. The I byte pending
+        before them has lost its Q byte, and if an odd number of bytes of the
+        stream is lost, the next one is a Q byte that is skipped too."""
+        if (n_lost + self.num_pending_bytes) % 2:
+            self.recv_into_(memoryview(self.discard_buf)[:1])
+        self.drop_pending_byte_()
+
+    def drop_samples(self):
+        """Drop the samples received so far, for example after retuning.
+        A pending I byte is kept, its Q byte is still to be received."""
+        with self.data_lock:
+            # The data given to the consumer stays before read_ix
+            if self.num_bytes_in_use:
+                self.num_bytes_in_use += self.num_bytes
+            self.read_ix = (self.read_ix + self.num_bytes) % self.max_num_bytes
+            self.num_bytes = 0
+
+    def set_frequency(self, freq):
+        """Retune to freq in Hz. The samples already received are dropped.
+        Before the source is started, this changes the frequency it will be
+        started with. Returns False, and changes nothing, if the source
+        cannot be retuned."""
+        if not self.can_retune:
+            print("The {} source cannot be retuned".format(self.source_name))
+            return False
+
+        self.freq = float(freq)
+        if self.retune_(freq=self.freq):
+            self.drop_samples()
+        return True
+
+    def set_gain(self, gain):
+        """Change the gain to gain in dB, see set_frequency()"""
+        if not self.can_retune:
+            print("The gain of the {} source cannot be changed".format(self.source_name))
+            return False
+
+        self.gain = float(gain)
+        if self.retune_(gain=self.gain):
+            self.drop_samples()
+        return True
+
     def get_samples(self, num_samples):
-        """Return a string containing num_bytes if that is available,
-        or return None if not enough data available"""
+        """Return the oldest num_samples samples as a np.uint8 array if that
+        is available, or return None if not enough data available.
+
+        The array is a view of the ring buffer when the data does not wrap
+        around its end, and is only valid until the next call."""
         ret = None
 
         num_bytes = num_samples * 2
 
-        self.data_lock.acquire()
+        with self.data_lock:
+            # The data returned by the previous call can now be overwritten
+            self.num_bytes_in_use = 0
 
-        try:
-            n_bytes = len(self.data_queue)
+            if self.num_bytes >= num_bytes:
+                first = self.max_num_bytes - self.read_ix
+                if num_bytes <= first:
+                    ret = self.buf[self.read_ix:self.read_ix + num_bytes]
+                    self.num_bytes_in_use = num_bytes
+                else:
+                    ret = np.concatenate((self.buf[self.read_ix:],
+                        self.buf[:num_bytes - first]))
 
-            if n_bytes > num_bytes:
-                ret = "".join(
-                        self.data_queue.popleft()
-                        for i in range(num_bytes))
-        except:
-            raise
-        finally:
-            self.data_lock.release()
+                self.read_ix = (self.read_ix + num_bytes) % self.max_num_bytes
+                self.num_bytes -= num_bytes
 
         return ret
 
+class RTLSDR_Receiver(SampleReceiver):
+    """Connection between the rtlsdr and our script is done using a TCP socket. This
+    class handles running the rtl_tcp tool, and reads the incoming data stream into
+    the ring buffer. It is retuned with the rtl_tcp commands, without restarting it."""
+
+    source_name = "rtl_tcp"
+    can_retune = True
+
+    def __init__(self, options):
+        SampleReceiver.__init__(self, options)
+
+        self.rtl_tcp_port = 59152 # chosen randomly
+        self.client = rtl_tcp_client.RTLTCP_Client("localhost", self.rtl_tcp_port)
+
+        self.rtlsdr_proc = None
+
+        # Set when rtl_tcp says it is listening
+        self.event_listening = threading.Event()
+
+    def monitor_rtl_tcp_(self):
+        """Forward the output of rtl_tcp, and watch for the line telling
+        it accepts connections"""
+        for line in iter(self.rtlsdr_proc.stdout.readline, ""):
+            print("rtl_tcp: {}".format(line.rstrip()))
+            if "listening" in line:
+                self.event_listening.set()
+
+    def open_source_(self):
+        """Start rtl_tcp and connect to it as soon as it accepts connections.
+        Returns False if that did not happen in RTL_TCP_STARTUP_TIMEOUT."""
+        rtl_tcp_cmdline = shlex.split("rtl_tcp -f {} -s {} -g {} -p {}".format(self.freq, self.rate, self.gain, self.rtl_tcp_port))
+        # rtl_tcp does not flush its output, which is block-buffered when
+        # it goes to a pipe. stdbuf makes it line-buffered, so that we see
+        # the listening line when it is printed. Without stdbuf, the
+        # connection attempts every RTL_TCP_RETRY_INTERVAL still find out
+        # when rtl_tcp is ready.
+        for cmdline in (["stdbuf", "-oL"] + rtl_tcp_cmdline, rtl_tcp_cmdline):
+            try:
+                self.rtlsdr_proc = subprocess.Popen(cmdline,
+                        stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                        universal_newlines=True)
+                break
+            except OSError as e:
+                error = e
+        else:
+            print("Cannot start rtl_tcp: {}".format(error))
+            return False
+
+        monitor = threading.Thread(target=self.monitor_rtl_tcp_)
+        monitor.daemon = True
+        monitor.start()
+
+        deadline = self.start_time + RTL_TCP_STARTUP_TIMEOUT
+
+        while time.time() < deadline and not self.event_stop.is_set():
+            if self.rtlsdr_proc.poll() is not None:
+                print("rtl_tcp exited with code {}".format(self.rtlsdr_proc.returncode))
+                return False
+
+            try:
+                self.client.connect(timeout=max(deadline - time.time(), RTL_TCP_RETRY_INTERVAL))
+            except socket.error:
+                # Not listening yet, wait for its message, or try again a bit
+                # later in case it does not print it
+                if self.event_listening.wait(RTL_TCP_RETRY_INTERVAL):
+                    self.event_listening.clear()
+                continue
+            except ValueError as e:
+                print("rtl_tcp error: {}".format(e))
+                return False
+
+            print("Connected to rtl_tcp after {:.3f}s, tuner {} with {} gain values".format(
+                time.time() - self.start_time,
+                self.client.tuner_name(), self.client.gain_count))
+            return True
+
+        print("rtl_tcp did not accept connections within {}s".format(RTL_TCP_STARTUP_TIMEOUT))
+        return False
+
+    def recv_into_(self, buf):
+        return self.client.recv_into(buf)
+
+    def close_source_(self):
+        self.client.close()
+
+        if self.rtlsdr_proc is not None:
+            self.rtlsdr_proc.terminate()
+            self.rtlsdr_proc.wait()
+
+    def retune_(self, freq=None, gain=None):
+        if not self.client.connected():
+            return False
+
+        if freq is not None:
+            self.client.set_frequency(freq)
+        if gain is not None:
+            self.client.set_gain(gain)
+        return True
+
+class RTLSDR_PipeReceiver(SampleReceiver):
+    """Runs rtl_sdr writing the samples to its standard output, and reads them
+    from the pipe. This avoids the TCP connection, but rtl_sdr has to be
+    restarted to retune."""
+
+    source_name = "rtl_sdr"
+    can_retune = True
+
+    def __init__(self, options):
+        SampleReceiver.__init__(self, options)
+        self.rtlsdr_proc = None
+
+    def open_source_(self):
+        rtl_sdr_cmdline = shlex.split("rtl_sdr -f {} -s {} -g {} -".format(self.freq, self.rate, self.gain))
+        try:
+            self.rtlsdr_proc = subprocess.Popen(rtl_sdr_cmdline, stdout=subprocess.PIPE, bufsize=0)
+        except OSError as e:
+            print("Cannot start rtl_sdr: {}".format(e))
+            return False
+        return True
+
+    def recv_into_(self, buf):
+        return self.rtlsdr_proc.stdout.readinto(buf)
+
+    def close_source_(self):
+        if self.rtlsdr_proc is not None:
+            self.rtlsdr_proc.terminate()
+            self.rtlsdr_proc.wait()
+            self.rtlsdr_proc.stdout.close()
+            self.rtlsdr_proc = None
+
+    def retune_(self, freq=None, gain=None):
+        # Stopping rtl_sdr ends the stream, and the receiver starts it again
+        # with the new settings
+        proc = self.rtlsdr_proc
+        if proc is None:
+            return False
+
+        self.event_reopen.set()
+        proc.terminate()
+        return False
+
+class FileReplayReceiver(SampleReceiver):
+    """Replays a u8 recording at the sample rate, from the beginning again
+    when it reaches its end, for tests and benchmarks without receiver"""
+
+    source_name = "file replay"
+
+    def __init__(self, options):
+        SampleReceiver.__init__(self, options)
+        self.replay_file = options.replay_file
+        self.iq_fd = None
+
+    def open_source_(self):
+        try:
+            self.iq_fd = io.open(self.replay_file, "rb")
+        except IOError as e:
+            print("Cannot open {}: {}".format(self.replay_file, e))
+            return False
+
+        self.replay_start = time.time()
+        self.num_bytes_replayed = 0
+        return True
+
+    def recv_into_(self, buf):
+        n_read = self.iq_fd.readinto(buf)
+        if n_read == 0:
+            self.iq_fd.seek(0)
+            n_read = self.iq_fd.readinto(buf)
+
+        # Wait until the samples would have been received by a receiver
+        self.num_bytes_replayed += n_read
+        delay = self.replay_start + self.num_bytes_replayed / (2.0 * self.rate) - time.time()
+        if delay > 0:
+            self.event_stop.wait(delay)
+
+        return n_read
+
+    def close_source_(self):
+        if self.iq_fd is not None:
+            self.iq_fd.close()
+            self.iq_fd = None
+
+class StdinReceiver(SampleReceiver):
+    """Reads the samples from the standard input, for example from a receiver
+    tool started by the user"""
+
+    source_name = "stdin"
+
+    def __init__(self, options):
+        SampleReceiver.__init__(self, options)
+
+        # The runner process closes its standard input when it starts, keep
+        # our own file descriptor
+        self.stdin_fd = os.dup(sys.stdin.fileno())
+        self.stdin = None
+
+    def open_source_(self):
+        self.stdin = io.open(self.stdin_fd, "rb", buffering=0)
+        return True
+
+    def recv_into_(self, buf):
+        return self.stdin.readinto(buf)
+
+    def close_source_(self):
+        if self.stdin is not None:
+            self.stdin.close()
+            self.stdin = None
+
+# The sources that can be selected with --source, indexed by name
+SAMPLE_SOURCES = {
+        "rtl_tcp": RTLSDR_Receiver,
+        "rtl_sdr": RTLSDR_PipeReceiver,
+        "file": FileReplayReceiver,
+        "stdin": StdinReceiver,
+        }
+
 
 class RTLSDR_CIR_Runner(mp.Process):
-    def __init__(self, options, iq_file, fig_file):
-        """Initialise a new runner, which runs rtl_tcp
+    def __init__(self, options, iq_file, fig_file, result_file=None):
+        """Initialise a new runner, which receives samples from the
+        source selected in options, rtl_tcp by default,
         that will save to iq_file, and run the CIR analysis
-        that will save to fig_file.
+        that will save to fig_file, and the CIRResult to result_file
+        if given.
 
-        options must contain freq, rate and samps fields"""
+        options must contain freq, rate and samps fields, and source and
+        replay_file to select another source, see SAMPLE_SOURCES"""
         mp.Process.__init__(self)
 
         self.freq = float(options.freq)
         self.samps = int(options.samps)
+        self.oversample = int(options.oversample)
+
+        # The carrier frequency offset estimate of the previous run, used
+        # as starting point for the next one
+        self.cfo = 0.0
 
-        self.receiver = RTLSDR_Receiver(options)
+        source = getattr(options, "source", "rtl_tcp")
+        self.receiver = SAMPLE_SOURCES[source](options)
 
         self.events = mp.Queue()
 
         self.iq_file = iq_file
         self.fig_file = fig_file
+        self.result_file = result_file
 
     def stop(self):
         self.events.put("quit")
         self.join()
 
+    def retune(self, freq=None, gain=None):
+        """Ask the runner to change the frequency in Hz and the gain in dB of
+        the receiver, if given"""
+        if freq is not None:
+            self.events.put(("freq", float(freq)))
+        if gain is not None:
+            self.events.put(("gain", float(gain)))
+
+    def handle_event_(self, ev):
+        """Apply a retune event, see retune()"""
+        name, value = ev
+        if name == "freq":
+            if self.receiver.set_frequency(value):
+                # The frequency offset of the receiver is proportional to the
+                # frequency
+                self.cfo *= value / self.freq
+                self.freq = value
+        elif name == "gain":
+            self.receiver.set_gain(value)
+
     def run(self):
+        # Avoid measuring the FFTW plans again on every start
+        fft_plans.load_wisdom()
 
         self.receiver.start()
 
         while True:
             time.sleep(1)
             try:
-                samps = self.receiver.get_samples(self.samps)
-                if samps:
-                    print("Got {} samples".format(len(samps)))
-                    # The RTLSDR outputs u8 format
-                    iq_data = np.array( [ord(c) for c in samps], np.uint8 )
+                # The RTLSDR outputs u8 format
+                iq_data = self.receiver.get_samples(self.samps)
+                if iq_data is not None:
+                    print("Got {} samples".format(len(iq_data) // 2))
                     self.do_one_cir_run(iq_data)
                 else:
                     print("Got 0 samples")
@@ -177,23 +577,37 @@ class RTLSDR_CIR_Runner(mp.Process):
                 print("Keyhoard Interrupt")
                 break
 
+            # Handle all pending events, until the queue is empty or we
+            # have to quit
             try:
                 ev = self.events.get_nowait()
-                if ev == "quit":
-                    break
+                while ev != "quit":
+                    self.handle_event_(ev)
+                    ev = self.events.get_nowait()
+                break
             except mp.queues.Empty:
                 pass
 
         self.receiver.stop()
 
+        fft_plans.save_wisdom()
+
     def do_one_cir_run(self, iq_data):
         print("Starting correlation")
-        cir_corr = correlate_with_ref.CIR_Correlate(iq_data=iq_data, iq_format="u8")
+        cir_corr = correlate_with_ref.CIR_Correlate(iq_data=iq_data, iq_format="u8",
+                oversample=self.oversample, cfo=self.cfo)
+
+        result = cir_corr.compute(capture_time=time.time())
 
         title = "Correlation on {}kHz done at {}".format(
                 int(self.freq / 1000),
                 datetime.datetime.now().strftime("%Y-%m-%dT%H:%M:%S"))
-        cir_corr.plot(self.fig_file, title)
+        result.plot(self.fig_file, title)
+
+        if self.result_file:
+            result.save(self.result_file)
+
+        self.cfo = result.cfo
 
 @route('/')
 def index():
@@ -201,8 +615,39 @@ def index():
             freq = cli_args.freq,
             rate = cli_args.rate,
             gain = cli_args.gain,
+            can_retune = SAMPLE_SOURCES[cli_args.source].can_retune,
             fig_file = FIG_FILE)
 
+@route('/tune', method='POST')
+def tune():
+    """Retune the receiver to the frequency and gain given in the form"""
+    if not SAMPLE_SOURCES[cli_args.source].can_retune:
+        abort(400, "The {} source cannot be retuned".format(cli_args.source))
+
+    freq = request.forms.get('freq') or None
+    gain = request.forms.get('gain') or None
+
+    # Check both values before changing anything
+    try:
+        if freq is not None:
+            freq = float(freq)
+            if not 0 < freq < 2**32:
+                raise ValueError()
+        if gain is not None:
+            gain = float(gain)
+            if not -100 < gain < 100:
+                raise ValueError()
+    except ValueError:
+        abort(400, "Invalid frequency or gain")
+
+    if freq is not None:
+        cli_args.freq = "{:.0f}".format(freq)
+    if gain is not None:
+        cli_args.gain = "{:g}".format(gain)
+
+    rtlsdr_cir.retune(freq, gain)
+    redirect('/')
+
 @route('/static/<filename:path>')
 def send_static(filename):
     return static_file(filename, root='./static')
@@ -224,15 +669,30 @@ if __name__ == '__main__':
 
     parser.add_argument('--rate', default='2048000', help='Samplerate for RTLSDR receiver (2048000)', required=False)
 
+    # Options for the sample source
+    parser.add_argument('--source', default='rtl_tcp', choices=sorted(SAMPLE_SOURCES),
+            help='Where the u8 samples come from: rtl_tcp, rtl_sdr through a pipe, replay of the --replay-file recording at the sample rate, or stdin (rtl_tcp)',
+            required=False)
+    parser.add_argument('--replay-file', default=None, help='u8 recording replayed by the file source', required=False)
+
+    # Options for the analysis
+    parser.add_argument('--oversample', default=1, help='Oversampling factor of the CIR, to get finer time resolution (1)', required=False)
+
     cli_args = parser.parse_args()
 
+    if cli_args.source == 'file' and not cli_args.replay_file:
+        parser.error("The file source needs --replay-file")
+
     # File to save the recorded IQ file to
     IQ_FILE = "static/rtlsdr.iq"
 
     # The figures are saved to a file
     FIG_FILE = "static/rtlsdr.svg"
 
-    rtlsdr_cir = RTLSDR_CIR_Runner(cli_args, IQ_FILE, FIG_FILE)
+    # The result of the last analysis, for further processing
+    RESULT_FILE = "static/rtlsdr.npz"
+
+    rtlsdr_cir = RTLSDR_CIR_Runner(cli_args, IQ_FILE, FIG_FILE, RESULT_FILE)
     rtlsdr_cir.start()
 
     try:
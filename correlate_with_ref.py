@@ -18,57 +18,973 @@ import matplotlib
 # switch to the Agg backend
 # See http://matplotlib.org/faq/howto_faq.html#matplotlib-in-a-web-application-server
 # And http://matplotlib.org/examples/api/agg_oo.html#api-agg-oo
-if __name__ != "__main__":
-    from matplotlib.backends.backend_agg import FigureCanvasAgg as FigureCanvas
-else:
+# Saving a figure to a file also uses the Agg canvas when running as a script.
+from matplotlib.backends.backend_agg import FigureCanvasAgg as FigureCanvas
+if __name__ == "__main__":
     import matplotlib.pyplot as pp
 
 import matplotlib.figure
-import sys
+import multiprocessing as mp
+import argparse
+import time
+import iq_formats
+import fft_plans
+import tii
+from tii import TII_DTYPE
+from iq_formats import correct_cfo
 
 # T = 1/2048000 s
 # NULL symbol is 2656 T (about 1.3ms) long.
 T_NULL = 2656
 # Full transmission frame in TM1 is 96ms = 196608 T.
 T_TF = 196608
+# The phase reference symbol is made of a guard interval of 504 T, followed
+# by the useful part of 2048 T.
+T_GUARD = 504
+T_U = 2048
+# All 76 OFDM symbols of the frame, including the phase reference, are
+# 2552 T long.
+T_S = T_GUARD + T_U
+NUM_SYMBOLS = 76
+
+# The coarse-to-fine correlation decimates the signal by COARSE_DECIMATION,
+# and then correlates at full rate around the COARSE_CANDIDATES strongest
+# peaks of the decimated correlation. A peak must be the maximum within
+# COARSE_PEAK_DISTANCE decimated lags, so that a component falling between
+# two lags does not use two candidates.
+COARSE_DECIMATION = 4
+COARSE_CANDIDATES = 4
+COARSE_PEAK_DISTANCE = 2
+
+# The multipath components are detected with a cell-averaging CFAR: the
+# power of each lag is compared to the mean power of CFAR_TRAINING_CELLS lags
+# on the quieter side, leaving out CFAR_GUARD_CELLS lags next to it that
+# contain the same component. A lag is a component if its power is CFAR_THRESHOLD
+# dB above this noise estimate. The cells are given in samples.
+CFAR_GUARD_CELLS = 3 # T
+CFAR_TRAINING_CELLS = 32 # T
+CFAR_THRESHOLD = 15 # dB
+
+# The correlation of the phase reference with the data symbols around it
+# leaves sidelobes about 27 dB below the main path, at the same delays in
+# every frame. Components more than CFAR_MAX_DYNAMIC_RANGE dB weaker than the
+# strongest one of their frame are therefore not reported.
+CFAR_MAX_DYNAMIC_RANGE = 24 # dB
+
+# One multipath component, in the frame of index frame of a CIRResult. The
+# delay is in samples, the amplitude is the value of the CIR, and the snr is
+# the ratio in dB between its power and the noise around it.
+COMPONENT_DTYPE = np.dtype([
+    ("frame", np.int32),
+    ("delay", np.float32),
+    ("amplitude", np.float32),
+    ("snr", np.float32)])
+
+# When selecting an estimator automatically, those declared more expensive
+# than ESTIMATOR_COST_LIMIT times the cheapest one are not even timed.
+ESTIMATOR_COST_LIMIT = 10
+
+# Once the NULL symbol timing is locked, the next NULL symbol is searched
+# in a window of +/- NULL_TRACKING_WINDOW around the predicted position.
+NULL_TRACKING_WINDOW = 64 # T
+
+# The timing stays locked while the power of the NULL symbol is below this
+# fraction of the average power of the frame.
+NULL_LOCK_RATIO = 0.5
+
+# Largest carrier frequency offset in Hz we look for. RTL-SDR receivers can be
+# off by several tens of ppm.
+MAX_CFO = 32000
+
+# A residual frequency offset smaller than this, in Hz, does not visibly
+# affect the correlation and is not corrected.
+CFO_TOLERANCE = 20
+
+# The integer part of the frequency offset is only trusted if the peak of its
+# metric is this many times above the mean of the metric. On noise alone the
+# ratio is around 2, with a DAB signal above 10.
+CFO_MIN_METRIC_RATIO = 5
+
+# In TM1, the longest spacing between carrier components one can allow is
+# around 504 T (246us, or 74km at speed of light). This gives us a limit
+# on the number of correlations it makes sense to do.
+MAX_COMPONENT_DELAY = 1000 # T
+
+# We start correlating a bit earlier than the end of the null symbol
+CORR_MARGIN = 50 # T
+
+# The FFT window used to decode the TII is in the middle of the NULL symbol,
+# so that small errors on its position do not matter.
+TII_WINDOW_OFFSET = (T_NULL - T_U) // 2 # T
+
+class PhaseReference:
+    """The phase reference symbol and the quantities derived from it that
+    the correlation needs. Use get_phase_reference() to get an instance."""
+
+    def __init__(self, samples, rate, mode):
+        self.rate = rate
+        self.mode = mode
+
+        self.samples = samples
+
+        # np.corrcoef removes the mean of both inputs, we do the same
+        self.zero_mean = self.samples - self.samples.mean()
+        self.energy = np.sum(np.abs(self.zero_mean)**2)
+
+        # Conjugate spectra of the zero-mean phase reference, indexed by FFT length
+        self.conj_spectra = {}
+
+        # Decimated versions of this phase reference, indexed by factor
+        self.decimated_refs = {}
+
+        # The known carrier values of the useful part, and their inverse set
+        # to zero on the carriers that are not used. They only exist for the
+        # phase reference at the nominal rate.
+        self.carriers = None
+        self.inv_carriers = None
+        if len(self.samples) == T_S:
+            self.carriers = np.fft.fft(self.samples[T_GUARD:T_GUARD + T_U])
+            active = np.abs(self.carriers) > 0.1 * np.abs(self.carriers).max()
+            self.inv_carriers = np.zeros(T_U, dtype=np.complex128)
+            self.inv_carriers[active] = 1.0 / self.carriers[active]
+
+    def __len__(self):
+        return len(self.samples)
+
+    def conj_spectrum(self, fft_len):
+        """Return the conjugate FFT of the zero-mean phase reference"""
+        if fft_len not in self.conj_spectra:
+            self.conj_spectra[fft_len] = np.conj(np.fft.fft(self.zero_mean, fft_len))
+        return self.conj_spectra[fft_len]
+
+    def decimated(self, factor):
+        """Return the PhaseReference decimated by factor, see decimate()"""
+        if factor not in self.decimated_refs:
+            self.decimated_refs[factor] = PhaseReference(
+                    decimate(self.samples, factor), self.rate // factor, self.mode)
+        return self.decimated_refs[factor]
+
+# The phase references already loaded, indexed by (rate, mode)
+_phase_references = {}
+
+def get_phase_reference(rate=2048000, mode=1):
+    """Return the PhaseReference for the given sample rate and transmission mode.
+    The file is only read once per process."""
+    if mode != 1:
+        raise ValueError("Unsupported transmission mode {}".format(mode))
+
+    key = (rate, mode)
+    if key not in _phase_references:
+        samples = np.fromfile("phasereference.{}.fc64.iq".format(rate), np.complex64)
+        _phase_references[key] = PhaseReference(samples, rate, mode)
+    return _phase_references[key]
+
+def decimate(samples, factor):
+    """Decimate samples along the last axis by averaging blocks of factor
+    samples. The boxcar average is a crude but cheap low-pass filter."""
+    num_blocks = samples.shape[-1] // factor
+    blocks = samples[..., :num_blocks * factor].reshape(
+            samples.shape[:-1] + (num_blocks, factor))
+    return blocks.mean(axis=-1)
+
+def estimate_cfo(channel, null_symbol_ixs, phase_ref, rate=2048000):
+    """Estimate the carrier frequency offset in Hz, using the transmission
+    frames whose NULL symbols start at the indices null_symbol_ixs of channel.
+
+    The fractional part, smaller than half the carrier spacing, is obtained from
+    the phase rotation between the guard intervals and the end of the OFDM
+    symbols. The multiple of the carrier spacing is then found by comparing the
+    spectrum of the phase reference symbols with the known carriers.
+
+    Returns None if no phase reference symbol is clearly visible, see
+    CFO_MIN_METRIC_RATIO."""
+
+    carrier_spacing = float(rate) / T_U
+
+    # Start of all the OFDM symbols that are completely in the channel
+    symbol_ixs = (np.asarray(null_symbol_ixs)[:, np.newaxis] + T_NULL +
+            T_S * np.arange(NUM_SYMBOLS)).ravel()
+    symbol_ixs = symbol_ixs[symbol_ixs + T_S <= len(channel)]
+
+    if len(symbol_ixs) == 0:
+        return None
+
+    guard_ixs = (symbol_ixs[:, np.newaxis] + np.arange(T_GUARD)).ravel()
+    cp_corr = np.sum(np.conj(channel[guard_ixs]) * channel[guard_ixs + T_U])
+    fractional_cfo = np.angle(cp_corr) / (2 * np.pi) * carrier_spacing
+
+    # The differential spectrum, product of neighbouring carriers, does not depend
+    # on the timing of the FFT window, nor on a flat channel.
+    ref_diff = np.roll(phase_ref.carriers, -1) * np.conj(phase_ref.carriers)
+    ref_diff_spectrum = np.conj(np.fft.fft(ref_diff))
+
+    # Start the FFT windows of the phase reference symbols in the middle of
+    # their guard interval, one window per row
+    window_ixs = np.asarray(null_symbol_ixs) + T_NULL + T_GUARD // 2
+    window_ixs = window_ixs[window_ixs + T_U <= len(channel)]
+    windows = channel[window_ixs[:, np.newaxis] + np.arange(T_U)]
+
+    derotate = np.exp(-2j * np.pi * fractional_cfo * np.arange(T_U) / rate)
+    carriers = np.fft.fft(windows * derotate, axis=-1)
+    diff = np.roll(carriers, -1, axis=-1) * np.conj(carriers)
+
+    # Circular correlation against the reference over all carrier offsets,
+    # summed over the frames
+    metric = np.abs(np.fft.ifft(np.fft.fft(diff, axis=-1) * ref_diff_spectrum,
+        axis=-1)).sum(axis=0)
+
+    max_offset = int(MAX_CFO / carrier_spacing)
+    offsets = np.arange(-max_offset, max_offset + 1)
+    offset_metric = metric[offsets]
+    if offset_metric.max() < CFO_MIN_METRIC_RATIO * offset_metric.mean():
+        return None
+
+    integer_offset = offsets[offset_metric.argmax()]
+
+    return integer_offset * carrier_spacing + fractional_cfo
+
+def null_block_powers_(channel, start_ix, first, last):
+    """Return the power of the blocks of length T_NULL starting at
+    start_ix + first to start_ix + last - 1, from one running sum"""
+    magnitude = np.abs(channel[start_ix + first:start_ix + last + T_NULL - 1])
+
+    cumsum = np.concatenate(([0], np.cumsum(magnitude, dtype=np.float64)))
+
+    return cumsum[T_NULL:] - cumsum[:-T_NULL]
+
+def find_null_symbol(channel, start_ix=0, search_len=T_TF, return_powers=False):
+    """Return the index, relative to start_ix, where the NULL symbol
+    starts in channel[start_ix:start_ix+search_len].
+
+    The power of every block of length T_NULL in the search range is
+    obtained from one running sum, which gives sample accurate timing.
+
+    With return_powers, the power of the NULL symbol and the average power
+    of all blocks are also returned, to tell how clearly it was found."""
+
+    block_power = null_block_powers_(channel, start_ix, 0, search_len - T_NULL)
+
+    # Look where the power is smallest, this gives the index where the NULL starts.
+    t_null = int(block_power.argmin())
+
+    if return_powers:
+        return t_null, block_power[t_null], block_power.mean()
+    return t_null
+
+class NullTracker:
+    """Finds the NULL symbols of consecutive transmission frames.
+
+    The first NULL symbol is searched over the whole frame. Once it is found
+    with enough confidence, the next one is expected at the same position in
+    the following frame, give or take some clock drift, and only a window of
+    +/- window samples around that position is searched. When the NULL is not
+    found in the window, or its power is not low enough compared to the
+    average power, the tracker falls back to a full search."""
+
+    def __init__(self, window=NULL_TRACKING_WINDOW):
+        """window is the half-width of the tracking window, 0 disables tracking"""
+        self.window = window
+
+        # Position of the last NULL symbol relative to the start of its frame,
+        # None when the timing is not locked
+        self.t_null = None
+
+        # Average power of the blocks in the last full search
+        self.average_power = None
+
+    def find(self, channel, start_ix, search_len=T_TF):
+        """Return the index, relative to start_ix, where the NULL symbol
+        starts in channel[start_ix:start_ix+search_len]"""
+        num_blocks = search_len - T_NULL
+
+        if self.window and self.t_null is not None:
+            first = max(0, self.t_null - self.window)
+            last = min(num_blocks, self.t_null + self.window + 1)
+
+            block_power = null_block_powers_(channel, start_ix, first, last)
+
+            if len(block_power):
+                ix = int(block_power.argmin())
+
+                # A minimum at the edge of the window means the NULL could be outside
+                at_edge = (ix == 0 and first > 0) or \
+                        (ix == len(block_power) - 1 and last < num_blocks)
+
+                if not at_edge and block_power[ix] < NULL_LOCK_RATIO * self.average_power:
+                    self.t_null = first + ix
+                    return self.t_null
+
+        t_null, null_power, self.average_power = find_null_symbol(
+                channel, start_ix, search_len, return_powers=True)
+
+        if null_power < NULL_LOCK_RATIO * self.average_power:
+            self.t_null = t_null
+        else:
+            self.t_null = None
+
+        return t_null
+
+def oversampled_ifft(spectrum, oversample):
+    """Inverse FFT along the last axis, interpolated by the integer factor
+    oversample by zero-padding the spectrum between its positive and negative
+    frequencies. Sample n * oversample of the result is equal to sample n of
+    the plain inverse FFT.
+
+    The result is the output buffer of a cached FFT plan, it is overwritten
+    by the next call with the same shape."""
+    fft_len = spectrum.shape[-1]
+    half = fft_len // 2
+
+    plan = fft_plans.get_plan(spectrum.shape[:-1] + (fft_len * oversample,), inverse=True)
+    if oversample == 1:
+        plan.input[...] = spectrum
+    else:
+        plan.input[..., :half] = spectrum[..., :half]
+        plan.input[..., half:-(fft_len - half)] = 0
+        plan.input[..., -(fft_len - half):] = spectrum[..., half:]
+
+    result = plan.execute()
+    if oversample > 1:
+        result *= oversample
+    return result
+
+def lag_axis(num_lags, oversample=1):
+    """Return the lags in samples, that can be fractional, corresponding
+    to the CIR values of an estimator called with num_lags and oversample"""
+    return np.arange(num_lags * oversample) / float(oversample)
+
+def window_energies_(segments, ref_len, num_lags):
+    """Return the energy of the windows of length ref_len starting at lags 0
+    to num_lags-1 of segments, with their mean removed like np.corrcoef does.
+    The result is a work buffer, overwritten by the next call."""
+
+    # The variance of each segment window is obtained from running sums:
+    # sum |x - mean|^2 = sum |x|^2 - |sum x|^2 / N
+    # All intermediate arrays are work buffers reused from call to call.
+    shape = segments.shape[:-1]
+    cumsum = fft_plans.get_buffer("cumsum", shape + (segments.shape[-1] + 1,), np.complex128)
+    cumsum[..., 0] = 0
+    np.cumsum(segments, axis=-1, out=cumsum[..., 1:])
+
+    power = fft_plans.get_buffer("power", segments.shape, np.float64)
+    np.abs(segments, out=power)
+    power **= 2
+    cumsum_energy = fft_plans.get_buffer("cumsum_energy", cumsum.shape, np.float64)
+    cumsum_energy[..., 0] = 0
+    np.cumsum(power, axis=-1, out=cumsum_energy[..., 1:])
+
+    window_sum = fft_plans.get_buffer("window_sum", shape + (num_lags,), np.complex128)
+    np.subtract(cumsum[..., ref_len:ref_len + num_lags], cumsum[..., :num_lags], out=window_sum)
+    window_sum_energy = fft_plans.get_buffer("window_sum_energy", window_sum.shape, np.float64)
+    np.abs(window_sum, out=window_sum_energy)
+    window_sum_energy **= 2
+    window_sum_energy /= ref_len
+
+    window_energy = fft_plans.get_buffer("window_energy", window_sum.shape, np.float64)
+    np.subtract(cumsum_energy[..., ref_len:ref_len + num_lags], cumsum_energy[..., :num_lags],
+            out=window_energy)
+    window_energy -= window_sum_energy
+
+    # Avoid division by zero for windows containing only zeros
+    return np.maximum(window_energy, np.finfo(np.float64).tiny, out=window_energy)
+
+def normalised_correlation(segments, phase_ref, num_lags, oversample=1, out=None):
+    """Calculate the magnitude of the correlation coefficient between the
+    PhaseReference phase_ref and the windows of segments starting at lags 0
+    to num_lags-1.
+
+    This gives the same result as calling np.corrcoef for every lag, but uses
+    one FFT per segment. segments is either one segment, or a 2-D array
+    containing one segment per row, and every segment must contain at least
+    len(phase_ref) + num_lags - 1 samples.
+
+    With oversample > 1, the correlation is interpolated to lags that are
+    multiples of 1/oversample by zero-padding the cross-spectrum.
+
+    The result has shape segments.shape[:-1] + (num_lags * oversample,), and
+    is written to out if given."""
+
+    ref_len = len(phase_ref)
+    corr_len = ref_len + num_lags - 1
+
+    if segments.shape[-1] < corr_len:
+        raise ValueError("Segment too short: {} < {}".format(segments.shape[-1], corr_len))
+
+    segments = segments[..., :corr_len]
+
+    # Next power of two large enough to avoid circular wrap-around
+    fft_len = 1 << int(np.ceil(np.log2(corr_len)))
+
+    # Using the zero-mean phase reference is enough for the cross term, because
+    # the mean of the segment window multiplies the sum of the zero-mean
+    # reference, which is zero.
+    plan = fft_plans.get_plan(segments.shape[:-1] + (fft_len,))
+    plan.input[..., :corr_len] = segments
+    plan.input[..., corr_len:] = 0
+    spectrum = plan.execute()
+    spectrum *= phase_ref.conj_spectrum(fft_len)
+    cross = oversampled_ifft(spectrum, oversample)[..., :num_lags * oversample]
+
+    window_energy = window_energies_(segments, ref_len, num_lags)
+
+    if oversample > 1:
+        # The window energy varies slowly, linear interpolation is enough
+        lags = lag_axis(num_lags, oversample)
+        lag_ix = lags.astype(int)
+        lag_next_ix = np.minimum(lag_ix + 1, num_lags - 1)
+        weight = lags - lag_ix
+        window_energy = (window_energy[..., lag_ix] * (1 - weight) +
+                window_energy[..., lag_next_ix] * weight)
+
+    if out is None:
+        out = np.empty(cross.shape)
+    window_energy *= phase_ref.energy
+    np.sqrt(window_energy, out=window_energy)
+    np.abs(cross, out=out)
+    out /= window_energy
+    return out
+
+def channel_estimate(segments, phase_ref, num_lags, oversample=1, out=None):
+    """Estimate the CIR in the frequency domain, by dividing the spectrum of
+    the received phase reference symbol by the known carrier values.
+
+    Takes the same arguments as normalised_correlation, and gives the same
+    result layout: the FFT window starts CORR_MARGIN samples before the end
+    of the guard interval, which delays the CIR by CORR_MARGIN samples, the
+    same way the correlation does. The magnitude is normalised to the energy
+    of the estimated CIR."""
+
+    if num_lags > T_U:
+        raise ValueError("Cannot estimate more than {} lags".format(T_U))
+
+    if segments.shape[-1] < T_GUARD + T_U:
+        raise ValueError("Segment too short: {} < {}".format(
+            segments.shape[-1], T_GUARD + T_U))
+
+    plan = fft_plans.get_plan(segments.shape[:-1] + (T_U,))
+    plan.input[...] = segments[..., T_GUARD:T_GUARD + T_U]
+    spectrum = plan.execute()
+    spectrum *= phase_ref.inv_carriers
+    cir = oversampled_ifft(spectrum, oversample)
+
+    # Oversampling multiplies the energy by the oversampling factor
+    cir_energy = np.sum(np.abs(cir)**2, axis=-1, keepdims=True) / oversample
+    cir_energy = np.maximum(cir_energy, np.finfo(np.float64).tiny)
+
+    return np.divide(np.abs(cir[..., :num_lags * oversample]), np.sqrt(cir_energy), out=out)
+
+def refine_peaks(cirs):
+    """Return the index of the strongest peak of each CIR in the last axis
+    of cirs, refined to a fractional index by fitting a parabola through the
+    peak and its two neighbours"""
+    num_lags = cirs.shape[-1]
+
+    peak_ixs = cirs.argmax(axis=-1)[..., np.newaxis]
+
+    left = np.take_along_axis(cirs, np.maximum(peak_ixs - 1, 0), axis=-1)
+    centre = np.take_along_axis(cirs, peak_ixs, axis=-1)
+    right = np.take_along_axis(cirs, np.minimum(peak_ixs + 1, num_lags - 1), axis=-1)
+
+    # Vertex of the parabola, it is within half a sample of the peak.
+    # Peaks at the edges, or on a flat top, are not refined.
+    curvature = left - 2 * centre + right
+    refine = (curvature < 0) & (peak_ixs > 0) & (peak_ixs < num_lags - 1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        offset = np.where(refine, 0.5 * (left - right) / curvature, 0.0)
+
+    return (peak_ixs + np.clip(offset, -0.5, 0.5))[..., 0]
+
+def align_on_peaks(cirs, peak_ixs, position):
+    """Shift each CIR in the 2-D array cirs so that its peak at index
+    peak_ixs moves to index position. Values shifted in are set to zero."""
+    num_lags = cirs.shape[-1]
+
+    shifts = np.round(peak_ixs).astype(int) - int(position)
+    source_ixs = np.arange(num_lags) + shifts[:, np.newaxis]
+    valid = (source_ixs >= 0) & (source_ixs < num_lags)
+
+    aligned = np.take_along_axis(cirs, np.clip(source_ixs, 0, num_lags - 1), axis=-1)
+    aligned[~valid] = 0
+    return aligned
+
+def extract_components(cirs, oversample=1, guard_cells=CFAR_GUARD_CELLS,
+        training_cells=CFAR_TRAINING_CELLS, threshold=CFAR_THRESHOLD,
+        max_dynamic_range=CFAR_MAX_DYNAMIC_RANGE):
+    """Detect the multipath components in the (frames, lags) array cirs with
+    a smallest-of cell-averaging CFAR over the lag axis, see
+    CFAR_TRAINING_CELLS and CFAR_MAX_DYNAMIC_RANGE.
+
+    Only the maxima within the guard cells are kept, so that every
+    component is reported once, and their delay is refined like in
+    refine_peaks(). Near the ends of the lag axis, the noise is estimated
+    from the training cells that exist.
+
+    Returns an array of COMPONENT_DTYPE, ordered by frame and delay."""
+    cirs = np.atleast_2d(cirs)
+    num_frames, num_lags = cirs.shape
+    guard_cells *= oversample
+    training_cells *= oversample
+
+    power = np.abs(cirs)**2
+    cumsum = np.zeros((num_frames, num_lags + 1))
+    np.cumsum(power, axis=-1, out=cumsum[:, 1:])
+
+    # Training cells [left_start, left_stop) and [right_start, right_stop)
+    # of every lag, the same for all frames
+    lags = np.arange(num_lags)
+    left_start = np.clip(lags - guard_cells - training_cells, 0, num_lags)
+    left_stop = np.clip(lags - guard_cells, 0, num_lags)
+    right_start = np.clip(lags + guard_cells + 1, 0, num_lags)
+    right_stop = np.clip(lags + guard_cells + training_cells + 1, 0, num_lags)
+
+    # The smaller of the two side averages is used, so that a strong
+    # component on one side does not mask the weaker ones next to it. A side
+    # without training cells is ignored.
+    num_left = left_stop - left_start
+    num_right = right_stop - right_start
+    with np.errstate(divide='ignore', invalid='ignore'):
+        noise_left = np.where(num_left > 0,
+                (cumsum[:, left_stop] - cumsum[:, left_start]) / num_left, np.inf)
+        noise_right = np.where(num_right > 0,
+                (cumsum[:, right_stop] - cumsum[:, right_start]) / num_right, np.inf)
+    noise = np.maximum(np.minimum(noise_left, noise_right), np.finfo(np.float64).tiny)
+
+    # A component must be the strongest lag within its guard cells, this
+    # also rejects the sidelobes of the strong components
+    padded = np.pad(power, ((0, 0), (guard_cells, guard_cells)))
+    local_max = np.lib.stride_tricks.sliding_window_view(
+            padded, 2 * guard_cells + 1, axis=-1).max(axis=-1)
+
+    detected = ((power > noise * 10**(threshold / 10.0)) &
+            (power >= local_max) & np.isfinite(noise))
+
+    # Floor relative to the strongest component of each frame
+    strongest = np.where(detected, power, 0).max(axis=-1, keepdims=True)
+    detected &= power >= strongest * 10**(-max_dynamic_range / 10.0)
+
+    frame_ixs, lag_ixs = np.nonzero(detected)
+
+    components = np.empty(len(frame_ixs), dtype=COMPONENT_DTYPE)
+    components["frame"] = frame_ixs
+    components["amplitude"] = np.abs(cirs[frame_ixs, lag_ixs])
+    components["snr"] = 10 * np.log10(power[frame_ixs, lag_ixs] / noise[frame_ixs, lag_ixs])
+
+    # Same parabola as refine_peaks(), on the magnitudes
+    magnitude_left = np.abs(cirs[frame_ixs, np.maximum(lag_ixs - 1, 0)])
+    magnitude_right = np.abs(cirs[frame_ixs, np.minimum(lag_ixs + 1, num_lags - 1)])
+    curvature = magnitude_left - 2 * components["amplitude"] + magnitude_right
+    with np.errstate(divide='ignore', invalid='ignore'):
+        offset = np.where(curvature < 0, 0.5 * (magnitude_left - magnitude_right) / curvature, 0.0)
+    components["delay"] = (lag_ixs + np.clip(offset, -0.5, 0.5)) / float(oversample)
+
+    return components
+
+def split_components(components, num_frames):
+    """Split the array returned by extract_components() into a list with
+    the components of each of the num_frames frames"""
+    bounds = np.searchsorted(components["frame"], np.arange(1, num_frames))
+    return np.split(components, bounds)
+
+def coarse_to_fine_correlation(segments, phase_ref, num_lags, oversample=1, out=None):
+    """Calculate the normalised correlation in two stages, for machines too
+    slow to correlate over all lags at full rate.
+
+    The segments and the phase reference are first decimated by
+    COARSE_DECIMATION, and correlated over all lags. Around the
+    COARSE_CANDIDATES strongest peaks of this coarse correlation, the
+    correlation is then calculated at full rate. All other lags are
+    assumed to contain only noise, and are set to zero.
+
+    Takes the same arguments as normalised_correlation, oversampling is not
+    supported."""
+
+    if oversample != 1:
+        raise ValueError("Coarse-to-fine correlation does not support oversampling")
+
+    ref_len = len(phase_ref)
+    corr_len = ref_len + num_lags - 1
+
+    if segments.shape[-1] < corr_len:
+        raise ValueError("Segment too short: {} < {}".format(segments.shape[-1], corr_len))
+
+    segments_2d = segments[..., :corr_len].reshape(-1, corr_len)
+    num_segments = len(segments_2d)
+
+    # First stage on the decimated signal
+    coarse_ref = phase_ref.decimated(COARSE_DECIMATION)
+    coarse_num_lags = num_lags // COARSE_DECIMATION
+    coarse = normalised_correlation(
+            decimate(segments_2d, COARSE_DECIMATION), coarse_ref, coarse_num_lags)
+
+    # Only the local maxima are candidates. If there are fewer than
+    # COARSE_CANDIDATES, the remaining ones are taken among the other lags.
+    padded = np.pad(coarse, ((0, 0), (COARSE_PEAK_DISTANCE, COARSE_PEAK_DISTANCE)))
+    local_max = np.lib.stride_tricks.sliding_window_view(
+            padded, 2 * COARSE_PEAK_DISTANCE + 1, axis=-1).max(axis=-1)
+    peaks = np.where(coarse >= local_max, coarse, coarse - local_max)
+
+    num_candidates = min(COARSE_CANDIDATES, coarse_num_lags)
+    candidates = np.argpartition(peaks, -num_candidates, axis=-1)[:, -num_candidates:]
+
+    # Second stage at full rate, on the lags around the candidates
+    region = np.arange(-COARSE_DECIMATION + 1, COARSE_DECIMATION)
+    lags = (candidates[:, :, np.newaxis] * COARSE_DECIMATION + region).reshape(num_segments, -1)
+    lags = np.clip(lags, 0, num_lags - 1)
+
+    rows = np.arange(num_segments)[:, np.newaxis]
+    windows = np.lib.stride_tricks.sliding_window_view(segments_2d, ref_len, axis=-1)
+    cross = np.dot(windows[rows, lags], np.conj(phase_ref.zero_mean))
+
+    window_energy = window_energies_(segments_2d, ref_len, num_lags)[rows, lags]
+
+    if out is None:
+        out = np.empty(segments.shape[:-1] + (num_lags,))
+    out_2d = out.reshape(-1, num_lags)
+    out_2d[...] = 0
+    out_2d[rows, lags] = np.abs(cross) / np.sqrt(window_energy * phase_ref.energy)
+
+    return out
+
+def corrcoef_correlation(segments, phase_ref, num_lags, oversample=1, out=None):
+    """Calculate the normalised correlation by calling np.corrcoef for every
+    lag. This is slow, and kept as reference for the other estimators.
+
+    Takes the same arguments as normalised_correlation, oversampling is not
+    supported."""
+
+    if oversample != 1:
+        raise ValueError("corrcoef correlation does not support oversampling")
+
+    ref_len = len(phase_ref)
+    segments_2d = segments.reshape(-1, segments.shape[-1])
+
+    if out is None:
+        out = np.empty(segments.shape[:-1] + (num_lags,))
+    out_2d = out.reshape(-1, num_lags)
+
+    for segment, cir in zip(segments_2d, out_2d):
+        cir[:] = [np.abs(
+            np.corrcoef(segment[i:i + ref_len], phase_ref.samples)[0,1]
+            ) for i in range(num_lags)]
+
+    return out
+
+class CIREstimator:
+    """A method to calculate the CIR. function takes the same arguments as
+    normalised_correlation. accuracy is between 0 and 1, where 1 means the
+    result is the exact normalised correlation. cost is the expected
+    computation time relative to normalised_correlation, the actual one
+    depends on the machine, see select_estimator()."""
+
+    def __init__(self, name, function, accuracy, cost, supports_oversample):
+        self.name = name
+        self.function = function
+        self.accuracy = accuracy
+        self.cost = cost
+        self.supports_oversample = supports_oversample
+
+    def __call__(self, segments, phase_ref, num_lags, oversample=1, out=None):
+        return self.function(segments, phase_ref, num_lags, oversample, out=out)
+
+# The available methods to calculate the CIR, indexed by name
+CIR_ESTIMATORS = {}
+
+def register_estimator(estimator):
+    """Make the CIREstimator estimator available under its name"""
+    CIR_ESTIMATORS[estimator.name] = estimator
+
+register_estimator(CIREstimator("corrcoef", corrcoef_correlation,
+    accuracy=1.0, cost=100.0, supports_oversample=False))
+register_estimator(CIREstimator("correlation", normalised_correlation,
+    accuracy=1.0, cost=1.0, supports_oversample=True))
+register_estimator(CIREstimator("coarse", coarse_to_fine_correlation,
+    accuracy=0.9, cost=0.5, supports_oversample=False))
+register_estimator(CIREstimator("channel", channel_estimate,
+    accuracy=0.8, cost=0.5, supports_oversample=True))
+
+# The estimators chosen by select_estimator(), indexed by its arguments
+_selected_estimators = {}
+
+def benchmark_estimator(estimator, phase_ref, num_lags, oversample=1, repeat=3):
+    """Time estimator on a synthetic transmission frame made of the phase
+    reference, an echo and noise. Returns the best time in seconds, or None
+    if the estimator does not find the main path where it is expected."""
+    rng = np.random.RandomState(0)
+
+    corr_len = len(phase_ref) + num_lags - 1
+    segment = 0.01 * (rng.randn(corr_len) + 1j * rng.randn(corr_len))
+    segment[CORR_MARGIN:CORR_MARGIN + len(phase_ref)] += phase_ref.samples
+    segment[CORR_MARGIN + 20:CORR_MARGIN + 20 + len(phase_ref)] += 0.3 * phase_ref.samples
+    segment = (segment / np.abs(segment).max()).astype(np.complex64)
+
+    cir = np.empty(num_lags * oversample)
+    best_time = None
+    for i in range(repeat):
+        start_time = time.time()
+        estimator(segment, phase_ref, num_lags, oversample, out=cir)
+        elapsed = time.time() - start_time
+        if best_time is None or elapsed < best_time:
+            best_time = elapsed
+
+    if abs(refine_peaks(cir) / oversample - CORR_MARGIN) > 1:
+        return None
+
+    return best_time
+
+def select_estimator(rate=2048000, num_lags=MAX_COMPONENT_DELAY, oversample=1,
+        min_accuracy=1.0):
+    """Return the fastest CIREstimator on this machine whose accuracy is
+    at least min_accuracy. The estimators are timed on a synthetic frame the
+    first time, the choice is then kept for the process.
+
+    Estimators declared much more expensive than the cheapest candidate are
+    not timed."""
+    key = (rate, num_lags, oversample, min_accuracy)
+    if key in _selected_estimators:
+        return _selected_estimators[key]
+
+    phase_ref = get_phase_reference(rate)
+
+    candidates = [estimator for estimator in CIR_ESTIMATORS.values()
+            if estimator.accuracy >= min_accuracy and
+            (oversample == 1 or estimator.supports_oversample)]
+    if not candidates:
+        raise ValueError("No estimator with accuracy {}".format(min_accuracy))
+
+    min_cost = min(estimator.cost for estimator in candidates)
+
+    best = None
+    best_time = None
+    for estimator in sorted(candidates, key=lambda estimator: estimator.cost):
+        if estimator.cost > ESTIMATOR_COST_LIMIT * min_cost:
+            continue
+
+        elapsed = benchmark_estimator(estimator, phase_ref, num_lags, oversample)
+        if elapsed is None:
+            print("Estimator {} failed on synthetic frame".format(estimator.name))
+            continue
+
+        print("Estimator {} takes {:.2f}ms".format(estimator.name, 1000 * elapsed))
+        if best_time is None or elapsed < best_time:
+            best = estimator
+            best_time = elapsed
+
+    if best is None:
+        raise ValueError("No working estimator with accuracy {}".format(min_accuracy))
+
+    print("Selected estimator {}".format(best.name))
+    _selected_estimators[key] = best
+    return best
+
+def get_estimator(name, oversample=1, min_accuracy=1.0):
+    """Return the CIREstimator called name, or the one chosen by
+    select_estimator() if name is "auto" """
+    if name == "auto":
+        return select_estimator(oversample=oversample, min_accuracy=min_accuracy)
+
+    if name not in CIR_ESTIMATORS:
+        raise ValueError("Unsupported estimator {}".format(name))
+
+    estimator = CIR_ESTIMATORS[name]
+    if oversample != 1 and not estimator.supports_oversample:
+        raise ValueError("Estimator {} does not support oversampling".format(name))
+    return estimator
+
+def plot_cirs(cirs, plot_file, title, oversample=1):
+    """Plot the (frames, lags) array cirs, to the file plot_file if given,
+    otherwise to the screen"""
+    if plot_file:
+        fig = matplotlib.figure.Figure()
+        canvas = FigureCanvas(fig)
+    else:
+        fig = pp.figure()
+
+    lags = lag_axis(cirs.shape[1] // oversample, oversample)
+
+    fig.suptitle(title)
+    ax1 = fig.add_subplot(211)
+    ax1.plot(lags, cirs.sum(axis=0))
+    ax2 = fig.add_subplot(212)
+    ax2.imshow(cirs, aspect='auto',
+            extent=(lags[0], lags[-1] + 1.0 / oversample, len(cirs), 0))
+    ax2.set_xlabel("Delay (samples)")
+
+    if plot_file:
+        print("Save to file {}".format(plot_file))
+        canvas.print_figure(plot_file)
+    else:
+        print("Plotting to screen")
+        pp.show()
+
+class CIRResult:
+    """The CIRs calculated over several transmission frames, and the
+    information needed to interpret them, without the samples. It can be
+    plotted, saved and loaded without recalculating anything."""
+
+    __slots__ = ("cirs", "null_symbol_ixs", "channel_power", "peak_delays",
+            "timestamps", "capture_time", "rate", "oversample", "cfo", "tii")
+
+    def __init__(self, cirs, null_symbol_ixs, channel_power, rate=2048000,
+            oversample=1, cfo=None, capture_time=None, tii=None):
+        """cirs is the (frames, lags) array of CIRs, already normalised by the
+        channel_power of each frame. null_symbol_ixs are the indices of the
+        NULL symbols in the capture. capture_time is the time in seconds since
+        the epoch of the first sample, if known. tii is the array of
+        transmitters identified in the frames, see tii.decode_tii()."""
+
+        self.cirs = cirs
+        self.null_symbol_ixs = np.asarray(null_symbol_ixs, dtype=np.int64)
+        self.channel_power = np.asarray(channel_power, dtype=np.float64)
+        self.rate = rate
+        self.oversample = oversample
+        self.cfo = cfo
+        self.capture_time = capture_time
+        self.tii = np.zeros(0, dtype=TII_DTYPE) if tii is None else tii
+
+        # Delay of the strongest peak of each CIR in samples, refined to
+        # sub-sample accuracy
+        self.peak_delays = refine_peaks(cirs) / float(oversample)
+
+        # Time in seconds of each NULL symbol from the start of the capture
+        self.timestamps = self.null_symbol_ixs / float(rate)
+
+    def __len__(self):
+        return len(self.cirs)
+
+    def lags(self):
+        """Return the delays in samples corresponding to the CIR values"""
+        return lag_axis(self.cirs.shape[1] // self.oversample, self.oversample)
+
+    def aligned_cirs(self):
+        """Return the CIRs shifted so that their strongest peak is at the
+        position where the main path would be if the NULL symbol was
+        perfectly detected"""
+        return align_on_peaks(self.cirs,
+                self.peak_delays * self.oversample,
+                CORR_MARGIN * self.oversample)
+
+    def plot(self, plot_file, title, align=True):
+        """Plot the CIRs to plot_file, or to the screen. With align, every
+        CIR is aligned on its strongest peak, which makes plots comparable
+        between runs."""
+        cirs = self.aligned_cirs() if align else self.cirs
+        plot_cirs(cirs, plot_file, title, self.oversample)
+
+    def components(self, **cfar_args):
+        """Return the multipath components of the CIRs, see
+        extract_components() for the arguments and the result"""
+        return extract_components(self.cirs, self.oversample, **cfar_args)
+
+    def save(self, filename):
+        """Save the result to a .npz file, see load_result()"""
+        np.savez(filename,
+                cirs=self.cirs,
+                null_symbol_ixs=self.null_symbol_ixs,
+                channel_power=self.channel_power,
+                rate=self.rate,
+                oversample=self.oversample,
+                cfo=np.nan if self.cfo is None else self.cfo,
+                capture_time=np.nan if self.capture_time is None else self.capture_time,
+                tii=self.tii)
+
+def load_result(filename):
+    """Load a CIRResult saved with CIRResult.save()"""
+    data = np.load(filename)
+    cfo = float(data["cfo"])
+    capture_time = float(data["capture_time"])
+    return CIRResult(data["cirs"], data["null_symbol_ixs"], data["channel_power"],
+            rate=int(data["rate"]),
+            oversample=int(data["oversample"]),
+            cfo=None if np.isnan(cfo) else cfo,
+            capture_time=None if np.isnan(capture_time) else capture_time,
+            tii=data["tii"] if "tii" in data else None)
+
+def concatenate_results(results):
+    """Concatenate the CIRResults of consecutive parts of a capture, or of
+    several captures. The metadata of the first one is kept."""
+    first = results[0]
+
+    # The frame indices of the identified transmitters continue from one
+    # result to the next
+    identified = []
+    num_frames = 0
+    for result in results:
+        result_tii = result.tii.copy()
+        result_tii["frame"] += num_frames
+        identified.append(result_tii)
+        num_frames += len(result)
+
+    return CIRResult(
+            np.concatenate([result.cirs for result in results]),
+            np.concatenate([result.null_symbol_ixs for result in results]),
+            np.concatenate([result.channel_power for result in results]),
+            rate=first.rate,
+            oversample=first.oversample,
+            cfo=first.cfo,
+            capture_time=first.capture_time,
+            tii=np.concatenate(identified))
 
 class CIR_Correlate:
-    def __init__(self, iq_filename="", iq_format=None, iq_data=None):
+    def __init__(self, iq_filename="", iq_format=None, iq_data=None,
+            estimator="correlation", oversample=1, cfo=None, track_null=True,
+            min_accuracy=1.0):
         """Either call with iq_filename, or with iq_data containing
         a np.array with the data.
 
-        This class will then read phase reference from fixed file and
-        load IQ data from iq_filename, or use iq_data directly.
+        This class will then get the phase reference from the cache, which
+        reads it from a fixed file the first time, and load IQ data from
+        iq_filename, or use iq_data directly.
+
+        iq_format is one of the formats in iq_formats.IQ_FORMATS, for example
+        u8 for the RTL-SDR or fc64 for complex float
+
+        estimator is one of CIR_ESTIMATORS: "correlation" correlates the phase
+        reference against the signal, "channel" does a cheaper frequency-domain
+        channel estimation on the phase reference symbol, "coarse" does a
+        coarse-to-fine correlation search, "corrcoef" is the slow reference.
+        "auto" selects the fastest one on this machine whose accuracy is at
+        least min_accuracy, see select_estimator()
 
-        iq_format must be fc64 or u8"""
+        oversample is the integer factor by which the CIR is interpolated,
+        to get a time resolution finer than one sample
+
+        If cfo is given, the carrier frequency offset is corrected before the
+        correlation. cfo is the estimate in Hz to start from, usually the one
+        from the previous capture, and is corrected while converting the data.
+        The new estimate is available in the cfo attribute after the CIRs
+        have been calculated. A starting estimate beyond MAX_CFO is ignored,
+        and the estimate is reset to 0 when the capture does not allow a
+        reliable one, for example when it contains only noise.
+
+        With track_null, the NULL symbol is only searched around the position
+        predicted from the previous frame, see NullTracker."""
 
         if iq_format is None:
             raise ValueError("Incorrect initialisation")
 
-        self.phase_ref = np.fromfile("phasereference.2048000.fc64.iq", np.complex64)
+        self.oversample = int(oversample)
+        self.estimator = get_estimator(estimator, self.oversample, min_accuracy)
 
-        if iq_format == "u8":
-            if iq_filename:
-                channel_u8_interleaved = np.fromfile(iq_filename, np.uint8)
-            elif iq_data is not None:
-                channel_u8_interleaved = iq_data
-            else:
-                raise ValueError("Must give iq_filename or iq_data")
-            channel_u8_iq = channel_u8_interleaved.reshape(int(len(channel_u8_interleaved)/2), 2)
-            # This directly converts to fc64
-            channel_fc64_unscaled = channel_u8_iq[...,0] + np.complex64(1j) * channel_u8_iq[...,1]
-            channel_fc64_scaled = (channel_fc64_unscaled - 127.0) / 128.0
-            channel_fc64_dc_comp = channel_fc64_scaled - np.average(channel_fc64_scaled)
-            self.channel_out = channel_fc64_dc_comp
-        elif iq_format == "fc64":
-            if iq_filename:
-                self.channel_out = np.fromfile(iq_filename, np.complex64)
-            elif iq_data is not None:
-                self.channel_out = iq_data
-            else:
-                raise ValueError("Must give iq_filename or iq_data")
+        self.correct_cfo = cfo is not None
+        self.cfo = float(cfo) if self.correct_cfo else 0.0
+        if abs(self.cfo) > MAX_CFO:
+            self.cfo = 0.0
+
+        self.phase_ref = get_phase_reference()
+
+        sample_format = iq_formats.get_format(iq_format)
+        if iq_filename:
+            raw, sample_format = sample_format.open(iq_filename)
+        elif iq_data is not None:
+            raw = sample_format.view(iq_data)
         else:
-            raise ValueError("Unsupported format {}".format(iq_format))
+            raise ValueError("Must give iq_filename or iq_data")
+
+        # The initial frequency correction is done during the conversion
+        self.channel_out = sample_format.to_complex(raw, self.cfo)
+
+        # Complex data can be used without copy, and must then not be modified
+        self.channel_is_copy = self.channel_out is not raw
 
         print("  File contains {} samples ({}ms, {} transmission frames)".format(
             len(self.channel_out),
@@ -77,25 +993,17 @@ class CIR_Correlate:
 
         # Keep track of where the NULL symbols are located
         self.null_symbol_ixs = []
+        self.null_tracker = NullTracker(NULL_TRACKING_WINDOW if track_null else 0)
 
-    def calc_one_cir_(self, start_ix):
-        """Calculate correlation with phase reference for one start index"""
-
-        print("Correlation at {}".format(start_ix))
-        channel = self.channel_out
+    def locate_phase_ref_(self, start_ix):
+        """Find the NULL symbol in the transmission frame starting at start_ix,
+        and return the index relative to start_ix where the correlation
+        against the phase reference has to start"""
 
         # As we do not want to correlate of the whole recording that might be
         # containing several transmission frames, we first look for the null symbol in the
         # first 96ms
-
-        # Calculate power on blocks of length 2656 over the first 96ms. To gain speed,
-        # we move the blocks by N samples.
-        N = 20
-        channel_out_power = np.array([np.abs(channel[start_ix+t:start_ix+t+T_NULL]).sum() for t in range(0, T_TF-T_NULL, N)])
-
-        # Look where the power is smallest, this gives the index where the NULL starts.
-        # Because if the subsampling, we need to multiply the index.
-        t_null = N * channel_out_power.argmin()
+        t_null = self.null_tracker.find(self.channel_out, start_ix)
 
         self.null_symbol_ixs.append(t_null)
 
@@ -108,82 +1016,366 @@ class CIR_Correlate:
         # We want to correlate our known phase reference symbol against the received
         # signal, and give us some more margin about the exact position of the NULL
         # symbol.
+        return t_null + T_NULL - CORR_MARGIN
+
+    def calc_all_cirs_(self, capture_time=None):
+        """Calculate correlation with phase reference for all transmission
+        frames in one batch, and return them in a CIRResult"""
+
+        channel = self.channel_out
+        num_correlations = int(len(channel) / T_TF)
+        corr_len = len(self.phase_ref) + MAX_COMPONENT_DELAY - 1
+
+        corr_start_ixs = [i * T_TF + self.locate_phase_ref_(i * T_TF)
+                for i in range(num_correlations)]
+
+        if self.correct_cfo:
+            null_ixs = [corr_start_ix - T_NULL + CORR_MARGIN
+                    for corr_start_ix in corr_start_ixs]
+            residual_cfo = estimate_cfo(channel, null_ixs, self.phase_ref)
 
-        # We start a bit earlier than the end of the null symbol
-        corr_start_ix = t_null + T_NULL - 50
+            # Without a DAB signal, or with an estimate outside of the range
+            # we search, the estimate is meaningless and must not be carried
+            # over to the next capture.
+            if residual_cfo is None or abs(self.cfo + residual_cfo) > MAX_CFO:
+                print("No reliable carrier frequency offset estimate, starting again from 0")
+                self.cfo = 0.0
+                residual_cfo = 0.0
+            else:
+                self.cfo += residual_cfo
+                print("Carrier frequency offset {:.1f}Hz".format(self.cfo))
+
+            # When starting from a good estimate, the remaining offset is
+            # small enough to be ignored. Otherwise it costs one more pass.
+            if abs(residual_cfo) > CFO_TOLERANCE:
+                if not self.channel_is_copy:
+                    channel = self.channel_out = np.array(channel, dtype=np.complex64)
+                    self.channel_is_copy = True
+                correct_cfo(channel, residual_cfo)
+
+        # Stack the windows to correlate, one per transmission frame. The last
+        # window can extend beyond the end of the recording, the missing
+        # samples are left at zero. The NULL symbols are stacked the same
+        # way to decode the TII.
+        segments = np.zeros((num_correlations, corr_len), dtype=channel.dtype)
+        null_windows = np.zeros((num_correlations, T_U), dtype=channel.dtype)
+        for i, corr_start_ix in enumerate(corr_start_ixs):
+            window = channel[corr_start_ix:corr_start_ix + corr_len]
+            segments[i, :len(window)] = window
+
+            tii_start_ix = corr_start_ix + CORR_MARGIN - T_NULL + TII_WINDOW_OFFSET
+            window = channel[tii_start_ix:tii_start_ix + T_U]
+            null_windows[i, :len(window)] = window
+
+        identified = tii.decode_tii(null_windows)
 
-        # In TM1, the longest spacing between carrier components one can allow is
-        # around 504 T (246us, or 74km at speed of light). This gives us a limit
-        # on the number of correlations it makes sense to do.
-        max_component_delay = 1000 # T
+        print("Correlation of {} transmission frames".format(num_correlations))
 
-        cir = np.array([np.abs(
-            np.corrcoef(channel[
-                start_ix + corr_start_ix + i:
-                start_ix + corr_start_ix + self.phase_ref.size + i
-                ] , self.phase_ref)[0,1]
-            ) for i in range(max_component_delay)])
+        cirs = np.empty((num_correlations, MAX_COMPONENT_DELAY * self.oversample))
+        self.estimator(segments, self.phase_ref, MAX_COMPONENT_DELAY, self.oversample, out=cirs)
 
         # In order to be able to compare measurements accross transmission frames,
         # we normalise the CIR against channel power
-        channel_power = np.abs(channel[start_ix:start_ix+T_TF]).sum()
+        channel_power = np.abs(channel[:num_correlations * T_TF]).reshape(
+                num_correlations, T_TF).sum(axis=1)
+        cirs /= channel_power[:, np.newaxis]
 
-        return cir / channel_power
+        null_symbol_ixs = [i * T_TF + t_null
+                for i, t_null in enumerate(self.null_symbol_ixs)]
 
-    def plot(self, plot_file, title):
-        num_correlations = int(len(self.channel_out) / T_TF)
+        return CIRResult(cirs, null_symbol_ixs, channel_power,
+                oversample=self.oversample,
+                cfo=self.cfo if self.correct_cfo else None,
+                capture_time=capture_time,
+                tii=identified)
 
+    def compute(self, capture_time=None):
+        """Calculate the CIRs of all transmission frames, and return them
+        in a CIRResult. capture_time is the time in seconds since the
+        epoch of the first sample, if known."""
         self.null_symbol_ixs = []
+        return self.calc_all_cirs_(capture_time)
 
-        cirs = np.array([
-            self.calc_one_cir_(i * T_TF)
-            for i in range(num_correlations) ])
+    def plot(self, plot_file, title, align=True):
+        """Calculate the CIRs and plot them to plot_file, or to the screen.
+        Returns the CIRResult, see CIRResult.plot() for align."""
+        result = self.compute()
+        result.plot(plot_file, title, align)
+        return result
 
-        if plot_file:
-            fig = matplotlib.figure.Figure()
-            canvas = FigureCanvas(fig)
-        else:
-            fig = pp.figure()
+class CIR_Stream:
+    """Streaming version of CIR_Correlate. Complex samples are given to
+    push() in chunks of any size, and the CIR of every transmission frame
+    is calculated as soon as enough samples for it have been received.
 
-        fig.suptitle(title)
-        ax1 = fig.add_subplot(211)
-        ax1.plot(cirs.sum(axis=0))
-        ax2 = fig.add_subplot(212)
-        ax2.imshow(cirs, aspect='auto')
+    Only the samples of the frame being analysed and the overlap into the
+    next frame are kept, so memory use does not depend on the length of
+    the stream."""
 
-        if plot_file:
-            print("Save to file {}".format(plot_file))
-            canvas.print_figure(plot_file)
-        else:
-            print("Plotting to screen")
-            pp.show()
+    def __init__(self, rate=2048000, estimator="correlation", oversample=1,
+            stream_ix=0, track_null=True, min_accuracy=1.0):
+        """stream_ix is the index of the first sample that will be pushed,
+        for streams that do not start at the beginning of a recording.
+        The other arguments are the same as for CIR_Correlate."""
+        self.oversample = int(oversample)
+        self.estimator = get_estimator(estimator, self.oversample, min_accuracy)
+
+        self.phase_ref = get_phase_reference(rate)
+
+        self.corr_len = len(self.phase_ref) + MAX_COMPONENT_DELAY - 1
+
+        # The NULL symbol can start anywhere in the frame, and the correlation
+        # window following it can therefore reach into the next frame.
+        self.num_samples_needed = T_TF + self.corr_len
+
+        self.buf = np.zeros(self.num_samples_needed + T_TF, dtype=np.complex64)
+        self.num_samples = 0
+
+        # Index in the stream of the first sample in buf
+        self.stream_ix = stream_ix
+
+        # Keep track of where the NULL symbols are located, relative to
+        # the start of the stream
+        self.null_symbol_ixs = []
+        self.null_tracker = NullTracker(NULL_TRACKING_WINDOW if track_null else 0)
+
+        # Power of each transmission frame, used to normalise its CIR
+        self.channel_power = []
+
+        # Transmitters identified in the NULL symbols, one array per frame
+        self.tii = []
+
+    def push(self, samples):
+        """Add complex samples to the stream, and return the list of CIRs
+        of the transmission frames that could be completed"""
+        cirs = []
+
+        while len(samples):
+            n = min(len(samples), len(self.buf) - self.num_samples)
+            self.buf[self.num_samples:self.num_samples + n] = samples[:n]
+            self.num_samples += n
+            samples = samples[n:]
+
+            while self.num_samples >= self.num_samples_needed:
+                cirs.append(self.calc_one_cir_())
+
+                # Keep the overlap with the next frame
+                remaining = self.num_samples - T_TF
+                self.buf[:remaining] = self.buf[T_TF:self.num_samples]
+                self.num_samples = remaining
+                self.stream_ix += T_TF
+
+        return cirs
+
+    def flush(self):
+        """Complete the last transmission frame of the stream with zeros,
+        the same way CIR_Correlate does at the end of a recording, and
+        return the list of CIRs that could be completed"""
+        if self.num_samples < T_TF:
+            return []
+
+        return self.push(np.zeros(self.num_samples_needed - self.num_samples,
+            dtype=np.complex64))
+
+    def calc_one_cir_(self):
+        """Calculate the CIR of the transmission frame at the start of buf"""
+        t_null = self.null_tracker.find(self.buf, 0)
+        self.null_symbol_ixs.append(self.stream_ix + t_null)
+
+        identified = tii.decode_tii(
+                self.buf[t_null + TII_WINDOW_OFFSET:t_null + TII_WINDOW_OFFSET + T_U])
+        identified["frame"] = len(self.tii)
+        self.tii.append(identified)
+
+        corr_start_ix = t_null + T_NULL - CORR_MARGIN
+
+        cir = self.estimator(
+                self.buf[corr_start_ix:corr_start_ix + self.corr_len],
+                self.phase_ref,
+                MAX_COMPONENT_DELAY,
+                self.oversample)
+
+        # In order to be able to compare measurements accross transmission frames,
+        # we normalise the CIR against channel power
+        channel_power = np.abs(self.buf[:T_TF]).sum()
+        self.channel_power.append(channel_power)
+
+        return cir / channel_power
+
+def analyse_file(iq_filename, iq_format, estimator="correlation", oversample=1,
+        first_frame=0, num_frames=None):
+    """Calculate the CIR of the transmission frames in the file iq_filename,
+    which is memory-mapped and converted one transmission frame at a time.
+    The memory used does not depend on the length of the file, except for
+    the result.
+
+    Only num_frames frames starting at first_frame are analysed if given,
+    otherwise all frames until the end of the file.
+
+    Returns a CIRResult."""
+
+    raw, sample_format = iq_formats.get_format(iq_format).open(iq_filename)
+    num_samples = sample_format.num_samples(raw)
+
+    if num_frames is None:
+        num_frames = num_samples // T_TF - first_frame
+
+    stream = CIR_Stream(estimator=estimator, oversample=oversample,
+            stream_ix=first_frame * T_TF)
+
+    cirs = np.empty((num_frames, MAX_COMPONENT_DELAY * oversample), dtype=np.float32)
+    num_cirs = 0
+
+    # The frame after the last one is needed because the correlation window
+    # can reach into it. It can be incomplete or missing.
+    for frame in range(first_frame, first_frame + num_frames + 1):
+        chunk = sample_format.to_complex(
+                sample_format.samples(raw, frame * T_TF, (frame + 1) * T_TF))
+
+        if frame == first_frame + num_frames:
+            chunk = chunk[:stream.corr_len]
+
+        for cir in stream.push(chunk):
+            cirs[num_cirs] = cir
+            num_cirs += 1
+
+    for cir in stream.flush():
+        cirs[num_cirs] = cir
+        num_cirs += 1
+
+    return CIRResult(cirs, stream.null_symbol_ixs, stream.channel_power,
+            oversample=oversample,
+            tii=np.concatenate(stream.tii) if stream.tii else None)
+
+def analyse_task_(task):
+    """Run analyse_file in a worker process, task is the tuple of arguments.
+    The FFTW wisdom of the process is returned with the result, so that the
+    parent can save it."""
+    return analyse_file(*task), fft_plans.export_wisdom()
+
+def analyse_files(iq_filenames, iq_format, estimator="correlation", oversample=1, jobs=1,
+        min_accuracy=1.0):
+    """Calculate the CIR of every transmission frame in the files iq_filenames.
+
+    With jobs > 1, the files are split into chunks of whole transmission
+    frames, analysed by a pool of jobs processes. Every process memory-maps
+    the file itself, only the results are sent back. These are merged in the
+    order of the files and frames. The processes start with the FFTW wisdom
+    of this one, and the wisdom they gather is added to it.
+
+    Returns a CIRResult for all files, where the NULL symbol indices are
+    relative to the start of their file."""
+
+    # Select the estimator once, instead of in every process
+    estimator = get_estimator(estimator, oversample, min_accuracy).name
+
+    tasks = []
+    for iq_filename in iq_filenames:
+        raw, sample_format = iq_formats.get_format(iq_format).open(iq_filename)
+        num_samples = sample_format.num_samples(raw)
+        num_frames = num_samples // T_TF
+
+        print("  File {} contains {} samples ({}ms, {} transmission frames)".format(
+            iq_filename,
+            num_samples,
+            num_samples / 2048000.0,
+            num_samples / float(T_TF)))
+
+        # Several chunks per process balance the load between them
+        frames_per_task = max(1, -(-num_frames // (4 * jobs)))
+
+        for first_frame in range(0, num_frames, frames_per_task):
+            tasks.append((iq_filename, iq_format, estimator, oversample,
+                first_frame, min(frames_per_task, num_frames - first_frame)))
+
+    if jobs > 1:
+        # The processes already use the cores, more FFT threads would compete
+        pool = mp.Pool(jobs, fft_plans.init_process,
+                (max(1, mp.cpu_count() // jobs), fft_plans.export_wisdom()))
+        try:
+            task_results = pool.map(analyse_task_, tasks)
+        finally:
+            pool.close()
+            pool.join()
+
+        for result, wisdom in task_results:
+            fft_plans.import_wisdom(wisdom)
+        results = [result for result, wisdom in task_results]
+    else:
+        results = [analyse_file(*task) for task in tasks]
+
+    if not results:
+        return CIRResult(np.empty((0, MAX_COMPONENT_DELAY * oversample), dtype=np.float32),
+                [], [], oversample=oversample)
+
+    return concatenate_results(results)
 
 
 if __name__ == "__main__":
-    if len(sys.argv) < 2:
-        print("Usage")
-        print(" script [fc64|u8] <filename> [<figure filename>]")
-        print(" fc64: file is 32-bit float I + 32-bit float Q")
-        print(" u8:   file is 8-bit signed I + 8-bit signed Q")
-        print(" if <figure filename> is given, save the figure instead of showing it")
-        sys.exit(1)
+    parser = argparse.ArgumentParser(description='Find NULL symbols in IQ files, then correlate with the phase reference symbol and plot the resulting CIR')
+
+    parser.add_argument('iq_format', choices=sorted(iq_formats.IQ_FORMATS),
+            help=', '.join("{}: {}".format(name, iq_format.description)
+                for name, iq_format in sorted(iq_formats.IQ_FORMATS.items())))
+    parser.add_argument('iq_files', nargs='+', help='IQ files to analyse, the results are concatenated. For compatibility, a last file name with an image extension is used as --figure')
+    parser.add_argument('--figure', default=None, help='Save the figure to this file instead of showing it', required=False)
+    parser.add_argument('--jobs', default=1, help='Number of processes analysing transmission frames in parallel (1)', required=False)
+    parser.add_argument('--estimator', default='correlation', choices=sorted(CIR_ESTIMATORS) + ['auto'],
+            help='Method used to calculate the CIR, auto selects the fastest on this machine (correlation)', required=False)
+    parser.add_argument('--min-accuracy', default=1.0, help='Lowest accuracy of the estimator selected by auto, between 0 and 1 (1.0)', required=False)
+    parser.add_argument('--oversample', default=1, help='Oversampling factor of the CIR, to get finer time resolution (1)', required=False)
+    parser.add_argument('--save', default=None, help='Save the result to this .npz file', required=False)
+    parser.add_argument('--fftw-wisdom', default=fft_plans.WISDOM_FILE, help='File keeping the FFTW plans between runs when pyFFTW is installed ({})'.format(fft_plans.WISDOM_FILE), required=False)
+    parser.add_argument('--components', default=None, help='Save the multipath components of every frame to this .npy file', required=False)
+
+    cli_args = parser.parse_args()
+
+    # The figure used to be given as the optional last argument, it must not
+    # be analysed as a recording
+    image_extensions = tuple("." + ext for ext in
+            FigureCanvas(matplotlib.figure.Figure()).get_supported_filetypes())
+    if (len(cli_args.iq_files) > 1 and cli_args.figure is None and
+            cli_args.iq_files[-1].lower().endswith(image_extensions)):
+        cli_args.figure = cli_args.iq_files.pop()
+
+    for iq_file in cli_args.iq_files:
+        if iq_file.lower().endswith(image_extensions):
+            parser.error("{} looks like an image, not an IQ file. Use --figure to save the figure".format(iq_file))
+
+    fft_plans.load_wisdom(cli_args.fftw_wisdom)
 
     print("Reading file")
 
-    file_format = sys.argv[1]
-    file_in = sys.argv[2]
-    file_figure = None
-    if len(sys.argv) == 4:
-        file_figure = sys.argv[3]
+    result = analyse_files(cli_args.iq_files, cli_args.iq_format,
+            cli_args.estimator, int(cli_args.oversample), int(cli_args.jobs),
+            float(cli_args.min_accuracy))
+
+    fft_plans.save_wisdom(cli_args.fftw_wisdom)
 
-    cir_corr = CIR_Correlate(file_in, file_format)
+    if cli_args.save:
+        result.save(cli_args.save)
 
-    cir_corr.plot(file_figure, "Correlation")
+    result.plot(cli_args.figure, "Correlation")
 
     print("Null symbols at:")
-    print("  " + " ".join("{}".format(t_null)
-        for t_null in cir_corr.null_symbol_ixs))
+    print("  " + " ".join("{}".format(t_null % T_TF)
+        for t_null in result.null_symbol_ixs))
 
-    print("Done")
+    print("Strongest peaks at delays:")
+    print("  " + " ".join("{:.2f}".format(delay)
+        for delay in result.peak_delays))
+
+    components = result.components()
+    if cli_args.components:
+        np.save(cli_args.components, components)
 
+    print("Transmitters identified (main/sub):")
+    print("  " + " ".join("{}/{}".format(main, sub)
+        for main, sub in sorted(set(zip(result.tii["main"], result.tii["sub"])))))
 
+    print("Multipath components (delay/SNR dB):")
+    for frame_components in split_components(components, len(result)):
+        print("  " + " ".join("{:.2f}/{:.1f}".format(component["delay"], component["snr"])
+            for component in frame_components))
+
+    print("Done")
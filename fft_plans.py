@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+#
+# FFTs of fixed size with preallocated buffers, for the correlation that
+# repeats the same transforms for every transmission frame.
+#
+# pyFFTW is used when it is installed, with FFTW plans and wisdom, then
+# scipy.fft with several workers, and numpy.fft as last resort.
+#
+# Licence: The MIT License, see LICENCE file
+
+import numpy as np
+import multiprocessing as mp
+import os
+
+try:
+    import pyfftw
+    FFT_BACKEND = "pyfftw"
+except ImportError:
+    try:
+        import scipy.fft
+        FFT_BACKEND = "scipy"
+    except ImportError:
+        FFT_BACKEND = "numpy"
+
+# numpy.fft can only write into an existing array from NumPy 2.0
+NUMPY_FFT_OUT = int(np.__version__.split(".")[0]) >= 2
+
+# Number of threads used by one FFT
+_num_threads = mp.cpu_count()
+
+# File where the FFTW wisdom is kept between runs
+WISDOM_FILE = os.path.join(os.path.expanduser("~"), ".odr-dab-cir-fftw-wisdom")
+
+# The plans already created, indexed by (shape, dtype, inverse)
+_plans = {}
+
+# Work buffers, indexed by (name, shape, dtype)
+_buffers = {}
+
+def set_threads(num_threads):
+    """Set the number of threads used by the FFTs created from now on,
+    for example to 1 in processes that already run in parallel"""
+    global _num_threads
+    _num_threads = max(1, int(num_threads))
+    _plans.clear()
+
+def export_wisdom():
+    """Return the FFTW wisdom accumulated in this process, that can be given
+    to import_wisdom() in another one, or None for other backends"""
+    if FFT_BACKEND != "pyfftw":
+        return None
+    return pyfftw.export_wisdom()
+
+def import_wisdom(wisdom):
+    """Add wisdom returned by export_wisdom() to this process"""
+    if wisdom is not None and FFT_BACKEND == "pyfftw":
+        pyfftw.import_wisdom(wisdom)
+
+def init_process(num_threads, wisdom):
+    """Initialise a worker process of a pool, see set_threads() and
+    import_wisdom()"""
+    set_threads(num_threads)
+    import_wisdom(wisdom)
+
+def load_wisdom(filename=WISDOM_FILE):
+    """Load FFTW wisdom saved by save_wisdom(), to avoid measuring again.
+    Does nothing for other backends or if the file does not exist."""
+    if FFT_BACKEND != "pyfftw":
+        return
+    try:
+        with open(filename, "rb") as fd:
+            pyfftw.import_wisdom(tuple(fd.read().split(b"\n\n\n")))
+    except IOError:
+        pass
+
+def save_wisdom(filename=WISDOM_FILE):
+    """Save the FFTW wisdom accumulated in this process"""
+    if FFT_BACKEND != "pyfftw":
+        return
+    try:
+        with open(filename, "wb") as fd:
+            fd.write(b"\n\n\n".join(pyfftw.export_wisdom()))
+    except IOError as e:
+        print("Cannot save the FFTW wisdom to {}: {}".format(filename, e))
+
+def get_buffer(name, shape, dtype):
+    """Return a work buffer that is reused by all calls with the same
+    arguments. Its content is undefined, and it is only valid until the
+    next call with the same arguments."""
+    key = (name, shape, np.dtype(dtype))
+    if key not in _buffers:
+        _buffers[key] = np.empty(shape, dtype=dtype)
+    return _buffers[key]
+
+class FFTPlan:
+    """FFT along the last axis of an array of fixed shape and dtype.
+
+    The data to transform is written into input, and execute() returns
+    output, which holds the result until the next call. The inverse FFT is
+    normalised like np.fft.ifft."""
+
+    def __init__(self, shape, dtype, inverse):
+        self.shape = shape
+        self.inverse = inverse
+
+        if FFT_BACKEND == "pyfftw":
+            self.input = pyfftw.empty_aligned(shape, dtype=dtype)
+            self.output = pyfftw.empty_aligned(shape, dtype=dtype)
+            self.fftw = pyfftw.FFTW(self.input, self.output, axes=(-1,),
+                    direction="FFTW_BACKWARD" if inverse else "FFTW_FORWARD",
+                    flags=("FFTW_MEASURE",), threads=_num_threads)
+        else:
+            self.input = np.zeros(shape, dtype=dtype)
+            self.output = np.zeros(shape, dtype=dtype)
+
+    def execute(self):
+        if FFT_BACKEND == "pyfftw":
+            return self.fftw()
+        elif FFT_BACKEND == "scipy":
+            # scipy.fft cannot write into an existing array
+            if self.inverse:
+                self.output = scipy.fft.ifft(self.input, axis=-1, workers=_num_threads)
+            else:
+                self.output = scipy.fft.fft(self.input, axis=-1, workers=_num_threads)
+            return self.output
+        elif NUMPY_FFT_OUT:
+            if self.inverse:
+                return np.fft.ifft(self.input, axis=-1, out=self.output)
+            else:
+                return np.fft.fft(self.input, axis=-1, out=self.output)
+        else:
+            if self.inverse:
+                self.output[...] = np.fft.ifft(self.input, axis=-1)
+            else:
+                self.output[...] = np.fft.fft(self.input, axis=-1)
+            return self.output
+
+def get_plan(shape, dtype=np.complex128, inverse=False):
+    """Return the FFTPlan for the given shape and dtype, creating it the
+    first time"""
+    key = (shape, np.dtype(dtype), inverse)
+    if key not in _plans:
+        _plans[key] = FFTPlan(shape, dtype, inverse)
+    return _plans[key]
@@ -0,0 +1,227 @@
+#!/usr/bin/env python
+#
+# Readers for the I/Q sample formats of the different SDR receivers and
+# recording tools. Every format gives a zero-copy view of the file or of
+# the data in memory, and converts it to complex64 in blocks only when
+# its samples are needed.
+#
+# Licence: The MIT License, see LICENCE file
+
+import numpy as np
+import json
+import os
+
+# Number of samples converted at once, small enough to stay in the cache
+CONVERSION_BLOCK = 65536
+
+def rotate_block_(block, rotator, cfo, start, rate):
+    """Correct the carrier frequency offset of cfo Hz in block, in place.
+    block starts at sample index start, rotator is the correction for the
+    first len(block) samples of a block starting at index zero."""
+    block *= rotator[:len(block)]
+    block *= np.exp(-2j * np.pi * cfo * start / rate).astype(block.dtype)
+
+def correct_cfo(channel, cfo, rate=2048000):
+    """Correct the carrier frequency offset of cfo Hz in channel, in place"""
+    block_len = max(1, min(CONVERSION_BLOCK, len(channel)))
+    rotator = np.exp(-2j * np.pi * cfo * np.arange(block_len) / rate).astype(channel.dtype)
+
+    for start in range(0, len(channel), block_len):
+        rotate_block_(channel[start:start + block_len], rotator, cfo, start, rate)
+
+class IQFormat:
+    """Base class of the sample formats. dtype is the type of the values in
+    the file, and values_per_sample is 2 when I and Q are interleaved."""
+
+    name = None
+    dtype = None
+    values_per_sample = 2
+    description = ""
+
+    def open(self, iq_filename):
+        """Memory-map the file iq_filename. Returns the raw samples and the
+        IQFormat that has to be used to convert them."""
+        return np.memmap(iq_filename, self.dtype, mode="r"), self
+
+    def view(self, iq_data):
+        """Return the raw samples in iq_data, which can be a bytes object or
+        a np.array, without copying them when the type allows it"""
+        if isinstance(iq_data, (bytes, bytearray, memoryview)):
+            return np.frombuffer(iq_data, self.dtype)
+
+        iq_data = np.asarray(iq_data)
+        if iq_data.dtype == self.dtype:
+            return iq_data
+        elif iq_data.dtype.itemsize == np.dtype(self.dtype).itemsize:
+            return iq_data.view(self.dtype)
+        else:
+            raise ValueError("Cannot interpret {} data as {}".format(iq_data.dtype, self.name))
+
+    def num_samples(self, raw):
+        """Number of complete complex samples in raw"""
+        return len(raw) // self.values_per_sample
+
+    def samples(self, raw, start, stop):
+        """Return the raw values of the samples start to stop-1"""
+        return raw[start * self.values_per_sample:stop * self.values_per_sample]
+
+    def to_complex(self, raw, cfo=0.0, rate=2048000):
+        """Convert the raw samples to complex64. If cfo is not zero, the
+        carrier frequency offset of cfo Hz is corrected in the same pass."""
+        raise NotImplementedError()
+
+class InterleavedIntegers(IQFormat):
+    """Interleaved integer I and Q values. The receivers that give these have
+    a DC offset, which is removed."""
+
+    # Value corresponding to zero, and scaling to get to the [-1, 1] range
+    offset = 0.0
+    scale = 1.0
+
+    def convert_block_(self, raw_block, block):
+        """Write the complex values of the raw values raw_block into block"""
+        block.real = (raw_block[0::2] - self.offset) * self.scale
+        block.imag = (raw_block[1::2] - self.offset) * self.scale
+
+    def to_complex(self, raw, cfo=0.0, rate=2048000):
+        """Convert the raw samples to complex64, and remove the DC offset.
+
+        The conversion is done in blocks, so that the DC removal and the
+        frequency correction are applied in place while the block is still
+        in the cache."""
+        raw = np.ascontiguousarray(raw[:self.num_samples(raw) * 2])
+        num_samples = len(raw) // 2
+
+        channel = np.empty(num_samples, dtype=np.complex64)
+        if num_samples == 0:
+            return channel
+
+        # The DC offset is introduced by the receiver, it must be removed before
+        # the frequency correction moves it away from DC.
+        iq_mean = raw.reshape(-1, 2).mean(axis=0)
+        dc = np.complex64(complex(iq_mean[0] - self.offset, iq_mean[1] - self.offset) * self.scale)
+
+        block_len = min(CONVERSION_BLOCK, num_samples)
+        if cfo:
+            rotator = np.exp(-2j * np.pi * cfo * np.arange(block_len) / rate).astype(np.complex64)
+
+        for start in range(0, num_samples, block_len):
+            block = channel[start:start + block_len]
+            self.convert_block_(raw[2 * start:2 * (start + block_len)], block)
+            block -= dc
+
+            if cfo:
+                rotate_block_(block, rotator, cfo, start, rate)
+
+        return channel
+
+class Interleaved8Bit(InterleavedIntegers):
+    """8-bit I and Q values, converted with a table of the 65536 possible
+    I/Q pairs, indexed by the pair viewed as a native uint16"""
+
+    def __init__(self):
+        self.lut = None
+
+    def lookup_table(self):
+        if self.lut is None:
+            iq = np.arange(65536, dtype=np.uint16).view(self.dtype).reshape(-1, 2)
+            self.lut = np.empty(65536, dtype=np.complex64)
+            self.lut.real = (iq[:, 0] - self.offset) * self.scale
+            self.lut.imag = (iq[:, 1] - self.offset) * self.scale
+        return self.lut
+
+    def convert_block_(self, raw_block, block):
+        np.take(self.lookup_table(), raw_block.view(np.uint16), out=block)
+
+class U8(Interleaved8Bit):
+    name = "u8"
+    dtype = np.uint8
+    offset = 127.0
+    scale = 1.0 / 128.0
+    description = "8-bit unsigned I + 8-bit unsigned Q, RTL-SDR"
+
+class S8(Interleaved8Bit):
+    name = "s8"
+    dtype = np.int8
+    scale = 1.0 / 128.0
+    description = "8-bit signed I + 8-bit signed Q, HackRF"
+
+class S16(InterleavedIntegers):
+    name = "s16"
+    dtype = np.dtype("<i2")
+    scale = 1.0 / 32768.0
+    description = "16-bit little-endian signed I + Q, Airspy and SDRplay"
+
+class FC64(IQFormat):
+    """Complex float samples, that are used without conversion"""
+    name = "fc64"
+    dtype = np.complex64
+    values_per_sample = 1
+    description = "32-bit float I + 32-bit float Q"
+
+    def view(self, iq_data):
+        # Complex data of another precision can only be converted
+        if isinstance(iq_data, np.ndarray) and iq_data.dtype.kind == "c":
+            return iq_data.astype(np.complex64, copy=False)
+        return IQFormat.view(self, iq_data)
+
+    def to_complex(self, raw, cfo=0.0, rate=2048000):
+        if not cfo:
+            return raw
+
+        channel = np.array(raw, dtype=np.complex64)
+        correct_cfo(channel, cfo, rate)
+        return channel
+
+class CF32(FC64):
+    name = "cf32"
+    description = "same as fc64, name used by SigMF"
+
+class SigMF(IQFormat):
+    """SigMF recording, given by the name of its .sigmf-meta or .sigmf-data
+    file. The datatype in the metadata selects the format of the data file."""
+    name = "sigmf"
+    description = "SigMF recording with cu8, ci8, ci16_le or cf32_le data"
+
+    # SigMF datatypes and the corresponding formats
+    datatypes = {
+            "cu8": "u8",
+            "ci8": "s8",
+            "ci16_le": "s16",
+            "cf32_le": "cf32",
+            }
+
+    def open(self, iq_filename):
+        basename = os.path.splitext(iq_filename)[0]
+
+        with open(basename + ".sigmf-meta") as meta_fd:
+            meta = json.load(meta_fd)
+
+        datatype = meta["global"]["core:datatype"]
+        if datatype not in self.datatypes:
+            raise ValueError("Unsupported SigMF datatype {}".format(datatype))
+
+        rate = meta["global"].get("core:sample_rate")
+        if rate is not None and int(rate) != 2048000:
+            print("Warning: SigMF sample rate is {} != 2048000".format(rate))
+
+        return get_format(self.datatypes[datatype]).open(basename + ".sigmf-data")
+
+    def view(self, iq_data):
+        raise ValueError("SigMF needs a file, use the format of its datatype for iq_data")
+
+# The available sample formats, indexed by name
+IQ_FORMATS = {}
+
+def register_format(iq_format):
+    """Make the IQFormat instance iq_format available under its name"""
+    IQ_FORMATS[iq_format.name] = iq_format
+
+def get_format(name):
+    """Return the IQFormat registered under name"""
+    if name not in IQ_FORMATS:
+        raise ValueError("Unsupported format {}".format(name))
+    return IQ_FORMATS[name]
+
+for iq_format in (U8(), S8(), S16(), FC64(), CF32(), SigMF()):
+    register_format(iq_format)
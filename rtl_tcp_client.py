@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+#
+# Client for the protocol of rtl_tcp. After connecting, the server sends a
+# 12-byte header describing the dongle, followed by the u8 I/Q samples.
+# The client can send 5-byte commands on the same socket at any time to
+# change the tuning, without restarting rtl_tcp.
+#
+# Licence: The MIT License, see LICENCE file
+
+import socket
+import struct
+
+# The header starts with this magic
+RTL_TCP_MAGIC = b"RTL0"
+RTL_TCP_HEADER_LEN = 12
+
+# The commands, followed by a big-endian 32-bit parameter
+CMD_SET_FREQUENCY = 0x01
+CMD_SET_SAMPLE_RATE = 0x02
+CMD_SET_GAIN_MODE = 0x03
+CMD_SET_GAIN = 0x04
+CMD_SET_FREQ_CORRECTION = 0x05
+CMD_SET_AGC_MODE = 0x08
+
+# Tuner types in the header, as numbered by librtlsdr
+TUNER_TYPES = {
+        0: "unknown",
+        1: "E4000",
+        2: "FC0012",
+        3: "FC0013",
+        4: "FC2580",
+        5: "R820T",
+        6: "R828D",
+        }
+
+class RTLTCP_Client:
+    """Connection to a running rtl_tcp. The samples are read with recv_into(),
+    the tuning is changed with the set_ methods."""
+
+    def __init__(self, host="localhost", port=1234):
+        self.host = host
+        self.port = port
+
+        self.sock = None
+
+        # Filled from the header when connecting
+        self.tuner_type = None
+        self.gain_count = None
+
+    def connect(self, timeout=None):
+        """Connect to rtl_tcp and read the header. Raises socket.error if
+        rtl_tcp does not accept the connection, and ValueError if it does
+        not send a valid header."""
+        self.sock = socket.create_connection((self.host, self.port), timeout)
+        try:
+            self.read_header_()
+        except:
+            self.close()
+            raise
+
+        # The socket is used in blocking mode after the connection
+        self.sock.settimeout(None)
+
+    def connected(self):
+        return self.sock is not None
+
+    def read_header_(self):
+        header = b""
+        while len(header) < RTL_TCP_HEADER_LEN:
+            data = self.sock.recv(RTL_TCP_HEADER_LEN - len(header))
+            if not data:
+                raise ValueError("rtl_tcp closed the connection before sending its header")
+            header += data
+
+        magic, self.tuner_type, self.gain_count = struct.unpack(">4sII", header)
+        if magic != RTL_TCP_MAGIC:
+            raise ValueError("Invalid rtl_tcp header {!r}".format(header))
+
+    def tuner_name(self):
+        return TUNER_TYPES.get(self.tuner_type, "type {}".format(self.tuner_type))
+
+    def recv_into(self, buf):
+        """Receive samples into buf, see socket.recv_into"""
+        return self.sock.recv_into(buf)
+
+    def send_command_(self, command, param):
+        self.sock.sendall(struct.pack(">BI", command, int(param) & 0xFFFFFFFF))
+
+    def set_frequency(self, freq):
+        """Tune to freq in Hz"""
+        self.send_command_(CMD_SET_FREQUENCY, freq)
+
+    def set_sample_rate(self, rate):
+        """Set the sample rate in samples per second"""
+        self.send_command_(CMD_SET_SAMPLE_RATE, rate)
+
+    def set_gain(self, gain):
+        """Set the tuner gain in dB, and switch to manual gain. The tuner
+        uses the nearest gain it supports."""
+        self.send_command_(CMD_SET_GAIN_MODE, 1)
+        self.send_command_(CMD_SET_GAIN, round(float(gain) * 10))
+
+    def set_automatic_gain(self):
+        """Let the tuner select its gain"""
+        self.send_command_(CMD_SET_GAIN_MODE, 0)
+
+    def set_agc(self, enable):
+        """Enable or disable the AGC of the RTL2832 demodulator"""
+        self.send_command_(CMD_SET_AGC_MODE, 1 if enable else 0)
+
+    def set_freq_correction(self, ppm):
+        """Correct the frequency of the crystal by ppm parts per million"""
+        self.send_command_(CMD_SET_FREQ_CORRECTION, ppm)
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
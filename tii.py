@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+#
+# Decoder of the Transmitter Identification Information (TII), that some
+# transmitters of a single frequency network send in the NULL symbol, see
+# ETSI EN 300 401 clause 14.8. Only transmission mode I is supported.
+#
+# Every transmitter sends pairs of adjacent carriers selected by its main
+# identifier (the pattern of 4 comb positions b out of 8) and its sub
+# identifier (the comb c, 0 to 23), repeated in the 4 groups of 384
+# carriers. All patterns are matched at once on the carrier powers of the
+# NULL symbol.
+#
+# Licence: The MIT License, see LICENCE file
+
+import numpy as np
+
+# Number of sub identifiers, comb positions per pattern and carrier groups
+TII_NUM_SUBS = 24
+TII_NUM_COMBS = 8
+TII_NUM_GROUPS = 4
+
+# The 70 patterns of the main identifiers 0 to 69, in this order: all 8-bit
+# values with 4 bits set, in ascending order. Bit b of the pattern selects
+# the comb position b. TII_PATTERNS[main, b] is True if it is used.
+TII_PATTERN_VALUES = [p for p in range(1 << TII_NUM_COMBS) if bin(p).count("1") == 4]
+TII_PATTERNS = np.array([[(p >> b) & 1 for b in range(TII_NUM_COMBS)]
+    for p in TII_PATTERN_VALUES], dtype=bool)
+
+# A comb position is considered present if the mean power of its carriers
+# is TII_THRESHOLD dB above the median power of all carriers of the NULL
+# symbol, that contains mostly noise.
+TII_THRESHOLD = 8 # dB
+
+# One identified transmitter in the frame of index frame. The level is the
+# power of its weakest comb position above the noise, in dB.
+TII_DTYPE = np.dtype([
+    ("frame", np.int32),
+    ("main", np.int16),
+    ("sub", np.int16),
+    ("level", np.float32)])
+
+def tii_carriers():
+    """Return the (subs, combs, groups, 2) array of the carrier indices, from
+    -768 to 768, of the carrier pairs of every sub identifier and comb
+    position. The carrier index 0 at DC is not used, the upper half is
+    therefore shifted by one."""
+    c = np.arange(TII_NUM_SUBS)[:, np.newaxis, np.newaxis]
+    b = np.arange(TII_NUM_COMBS)[np.newaxis, :, np.newaxis]
+    i = np.arange(TII_NUM_GROUPS)[np.newaxis, np.newaxis, :]
+
+    k = -768 + 2 * c + 48 * b + 384 * i + (i >= 2)
+    return np.stack((k, k + 1), axis=-1)
+
+TII_CARRIERS = tii_carriers()
+
+def decode_tii(windows, threshold=TII_THRESHOLD):
+    """Identify the transmitters in NULL symbols. windows contains the
+    samples of one FFT window inside the NULL symbol, or one per row for
+    several frames. Its length is the FFT size, 2048 in mode I.
+
+    Several transmitters can be identified in the same frame. When some of
+    them have the same sub identifier, all patterns included in the union
+    of theirs are reported.
+
+    Returns an array of TII_DTYPE, ordered by frame, sub and main
+    identifier."""
+    windows = np.atleast_2d(windows)
+    fft_len = windows.shape[-1]
+
+    carrier_power = np.abs(np.fft.fft(windows, axis=-1))**2
+
+    # The active carriers are 1 to 768 and -768 to -1
+    active = np.concatenate((carrier_power[:, 1:769], carrier_power[:, -768:]), axis=-1)
+    noise = np.median(active, axis=-1)
+    noise = np.maximum(noise, np.finfo(np.float64).tiny)
+
+    # Mean power of the 8 carriers of every (sub, comb) combination, relative
+    # to the noise, as a (frames, subs, combs) array
+    comb_power = carrier_power[:, TII_CARRIERS % fft_len].mean(axis=(-2, -1))
+    comb_power /= noise[:, np.newaxis, np.newaxis]
+
+    # A transmitter is identified when all 4 comb positions of its pattern
+    # are present, that is when the pattern is included in the present ones
+    present = comb_power > 10**(threshold / 10.0)
+    matches = np.einsum("fcb,mb->fcm", present.astype(np.int32),
+            TII_PATTERNS.astype(np.int32)) == TII_PATTERNS.sum(axis=-1)
+    frame_ixs, subs, mains = np.nonzero(matches)
+
+    # Level of the weakest comb position of the pattern
+    pattern_power = np.where(TII_PATTERNS[mains], comb_power[frame_ixs, subs], np.inf)
+
+    identified = np.empty(len(frame_ixs), dtype=TII_DTYPE)
+    identified["frame"] = frame_ixs
+    identified["main"] = mains
+    identified["sub"] = subs
+    identified["level"] = 10 * np.log10(pattern_power.min(axis=-1))
+    return identified
@@ -19,6 +19,13 @@
                 <li>gain: {{gain}}</li>
                 <li>rate: {{rate}}</li>
             </ul>
+            % if can_retune:
+            <form action="tune" method="post">
+                frequency: <input name="freq" type="text" value="{{freq}}" />
+                gain: <input name="gain" type="text" value="{{gain}}" />
+                <input value="Tune" type="submit" />
+            </form>
+            % end
         </div>
 
         <div id="cir">